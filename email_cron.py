@@ -40,10 +40,16 @@ for expired_payment in expired_payments:
 	}
 	subscription_fuzzy_time = [v for k,v in subscription_fuzzy_time_map.items() if k[0] <= subscription_days and k[1] > subscription_days][0]
 
-	activity_records = db.activity_records.find_one({"UserID": connected_user["_id"]})
 	total_distance_synced = None
-	if activity_records:
-		total_distance_synced = sum([x["Distance"] for x in activity_records["Activities"] if x["Distance"]])
+	# Users who haven't been synced since records moved to one document per activity still have them all in the one document
+	legacy_activity_records = db.activity_records.find_one({"UserID": connected_user["_id"]})
+	if legacy_activity_records:
+		total_distance_synced = sum([x["Distance"] for x in legacy_activity_records["Activities"] if x["Distance"]])
+	else:
+		distance_totals = list(db.user_activity_records.aggregate([{"$match": {"UserID": connected_user["_id"]}}, {"$group": {"_id": None, "Distance": {"$sum": "$Distance"}}}]))
+		if distance_totals:
+			total_distance_synced = distance_totals[0]["Distance"]
+	if total_distance_synced is not None:
 		total_distance_synced = math.floor(total_distance_synced/1000 / 100) * 100
 
 	context = {
@@ -30,6 +30,7 @@ def celery_shutdown(**kwargs):
 @celery_app.task(acks_late=True)
 def trigger_poll(service_id, index):
     from tapiriik.auth import User
+    from tapiriik.sync.schedule import RedisSyncSchedule
     print("Polling %s-%d" % (service_id, index))
     svc = Service.FromID(service_id)
     affected_connection_external_ids = svc.PollPartialSyncTrigger(index)
@@ -44,7 +45,9 @@ def trigger_poll(service_id, index):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    trigger_time = datetime.utcnow()
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": trigger_time, "NextSyncLane": "triggered"}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    RedisSyncSchedule.ScheduleMatching(trigger_users_query, trigger_time)
 
     db.poll_stats.insert({"Service": service_id, "Index": index, "Timestamp": datetime.utcnow(), "TriggerCount": len(affected_connection_external_ids)})
 
@@ -22,6 +22,7 @@ def celery_shutdown(**kwargs):
 def trigger_remote(service_id, affected_connection_external_ids):
     from tapiriik.auth import User
     from tapiriik.services import Service
+    from tapiriik.sync.schedule import RedisSyncSchedule
     svc = Service.FromID(service_id)
     db.connections.update({"Service": svc.ID, "ExternalID": {"$in": affected_connection_external_ids}}, {"$set":{"TriggerPartialSync": True, "TriggerPartialSyncTimestamp": datetime.utcnow()}}, multi=True, w=MONGO_FULL_WRITE_CONCERN)
     affected_connection_ids = db.connections.find({"Service": svc.ID, "ExternalID": {"$in": affected_connection_external_ids}}, {"_id": 1})
@@ -29,4 +30,6 @@ def trigger_remote(service_id, affected_connection_external_ids):
     trigger_users_query = User.PaidUserMongoQuery()
     trigger_users_query.update({"ConnectedServices.ID": {"$in": affected_connection_ids}})
     trigger_users_query.update({"Config.suppress_auto_sync": {"$ne": True}})
-    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    trigger_time = datetime.utcnow()
+    db.users.update(trigger_users_query, {"$set": {"NextSynchronization": trigger_time, "NextSyncLane": "triggered"}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    RedisSyncSchedule.ScheduleMatching(trigger_users_query, trigger_time)
@@ -1,34 +1,156 @@
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.schedule import RedisSyncSchedule
+from tapiriik.sync.admission import SyncQueueProbe
+from tapiriik.settings import RABBITMQ_BROKER_URL, SYNC_SCHEDULER_BATCH_SIZE, SYNC_SCHEDULER_TARGET_RATE, SYNC_SCHEDULE_REDIS_RECONCILE_INTERVAL
 from datetime import datetime
 from pymongo.read_preferences import ReadPreference
 import kombu
+import socket
 import time
 import uuid
 
 Sync.InitializeWorkerBindings()
 
-producer = kombu.Producer(Sync._channel, Sync._exchange)
+# The shared connection waits for the broker to confirm each message as it's published - a round trip per user.
+# So this one gets its own, with confirms turned on by hand, and schedule_batch waits for a whole batch's worth at once.
+publish_connection = kombu.Connection(RABBITMQ_BROKER_URL)
+publish_channel = publish_connection.channel()
+publish_channel.confirm_select()
+producer = kombu.Producer(publish_channel, Sync._exchange)
+# How long (seconds) to wait for a batch to be confirmed before giving up on it
+confirm_timeout = 60
 
-while True:
+# Delivery tag -> True/False once the broker has acked/nacked that message
+# Tags count up from 1 with each message published on the channel
+confirmations = {}
+next_delivery_tag = 1
+
+def on_confirm(acked):
+    def _callback(delivery_tag, multiple):
+        for tag in ([x for x in confirmations if x <= delivery_tag] if multiple else [delivery_tag]):
+            if confirmations.get(tag, True) is None:
+                confirmations[tag] = acked
+    return _callback
+
+publish_channel.events["basic_ack"].add(on_confirm(True))
+publish_channel.events["basic_nack"].add(on_confirm(False))
+
+# Due users are claimed oldest-first, a batch at a time, straight off this index - so a backlog never has to fit in memory (or in one update)
+db.users.ensure_index("NextSynchronization", sparse=True)
+
+def schedule_batch(limit):
     generation = str(uuid.uuid4())
     queueing_at = datetime.utcnow()
+    due_query = {
+        "NextSynchronization": {"$lte": queueing_at},
+        "QueuedAt": {"$exists": False}
+    }
+    popped_ids = None
+    if RedisSyncSchedule.Enabled():
+        # The sorted set only says who to look at - the users collection still decides who's actually due
+        popped_ids = RedisSyncSchedule.PopDue(queueing_at, limit)
+        if not popped_ids:
+            return 0, 0, None
+        due_query["_id"] = {"$in": popped_ids}
     users = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(
-                {
-                    "NextSynchronization": {"$lte": datetime.utcnow()},
-                    "QueuedAt": {"$exists": False}
-                },
+                due_query,
                 {
                     "_id": True,
-                    "SynchronizationHostRestriction": True
+                    "NextSynchronization": True,
+                    "SynchronizationHostRestriction": True,
+                    # For Sync.SyncLane
+                    "NextSyncLane": True,
+                    "NextSyncIsExhaustive": True,
+                    "LastSynchronization": True
                 }
-            ))
+            ).sort("NextSynchronization", 1).limit(limit))
+    if popped_ids:
+        # Anyone popped that wasn't due after all (rescheduled since, say) goes back in at their real time
+        due_ids = set(x["_id"] for x in users)
+        for user in db.users.find({"_id": {"$in": [x for x in popped_ids if x not in due_ids]}, "NextSynchronization": {"$gt": queueing_at}}, {"NextSynchronization": True}):
+            RedisSyncSchedule.Schedule([user["_id"]], user["NextSynchronization"])
+    if not users:
+        return 0, len(popped_ids) if popped_ids else 0, None
     scheduled_ids = [x["_id"] for x in users]
-    print("Found %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
-    db.users.update({"_id": {"$in": scheduled_ids}}, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}}, multi=True)
-    print("Marked %d users as queued at %s" % (len(scheduled_ids), datetime.utcnow()))
-    for user in users:
-        producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else "")
-    print("Scheduled %d users at %s" % (len(scheduled_ids), datetime.utcnow()))
+    # How long the most overdue user in this batch has been waiting
+    lag = queueing_at - users[0]["NextSynchronization"]
+    due_query["_id"] = {"$in": scheduled_ids}
+    db.users.update(due_query, {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}}, multi=True)
+    global next_delivery_tag
+    delivery_tags = []
+    try:
+        for user in users:
+            producer.publish({"user_id": str(user["_id"]), "generation": generation}, routing_key=user["SynchronizationHostRestriction"] if "SynchronizationHostRestriction" in user and user["SynchronizationHostRestriction"] else Sync.LaneRoutingKey(Sync.SyncLane(user)))
+            confirmations[next_delivery_tag] = None
+            delivery_tags.append(next_delivery_tag)
+            next_delivery_tag += 1
+        # Then one wait for the broker to confirm the lot
+        confirm_deadline = time.time() + confirm_timeout
+        while any(confirmations[tag] is None for tag in delivery_tags) and time.time() < confirm_deadline:
+            try:
+                publish_connection.drain_events(timeout=confirm_deadline - time.time())
+            except socket.timeout:
+                break
+    finally:
+        # Whoever didn't make it into the queue goes back to being due - otherwise they'd sit marked as queued until someone requeued them by hand
+        # (if their message turns up after all, it's for a generation they're no longer in, so the worker skips it)
+        unconfirmed = [user for user, tag in zip(users, delivery_tags) if not confirmations.pop(tag)] + users[len(delivery_tags):]
+        for user in unconfirmed:
+            db.users.update({"_id": user["_id"], "QueuedGeneration": generation}, {"$set": {"NextSynchronization": user["NextSynchronization"]}, "$unset": {"QueuedAt": True, "QueuedGeneration": True}})
+            RedisSyncSchedule.Schedule([user["_id"]], user["NextSynchronization"])
+        if unconfirmed:
+            print("%d users in batch %s were not confirmed by the broker" % (len(unconfirmed), generation))
+    return len(users) - len(unconfirmed), len(popped_ids) if popped_ids else len(users), lag
+
+last_reconcile = None
+queue_probe = SyncQueueProbe.FromSettings()
+# With SYNC_SCHEDULER_TARGET_RATE, each pass can only dispatch as many users as have accrued since the last (up to a minute's worth)
+dispatch_allowance = 0
+last_pass = datetime.utcnow()
+
+while True:
+    if RedisSyncSchedule.Enabled() and (last_reconcile is None or (datetime.utcnow() - last_reconcile).total_seconds() > SYNC_SCHEDULE_REDIS_RECONCILE_INTERVAL):
+        last_reconcile = datetime.utcnow()
+        print("Reconciled %d users into the Redis schedule (took %s)" % (RedisSyncSchedule.Reconcile(), datetime.utcnow() - last_reconcile))
+
+    pass_start = datetime.utcnow()
+    if SYNC_SCHEDULER_TARGET_RATE:
+        dispatch_allowance = min(dispatch_allowance + (pass_start - last_pass).total_seconds() * SYNC_SCHEDULER_TARGET_RATE, SYNC_SCHEDULER_TARGET_RATE * 60)
+    last_pass = pass_start
+    # Whoever the workers can't get to soon stays put until they can
+    admission_limit = queue_probe.AdmissionLimit() if queue_probe else None
+    scheduled_count = 0
+    max_lag = None
+    while True:
+        limit = min(SYNC_SCHEDULER_BATCH_SIZE, int(dispatch_allowance)) if SYNC_SCHEDULER_TARGET_RATE else SYNC_SCHEDULER_BATCH_SIZE
+        if admission_limit is not None:
+            limit = min(limit, admission_limit)
+        if limit <= 0:
+            break
+        batch_count, considered_count, lag = schedule_batch(limit)
+        scheduled_count += batch_count
+        dispatch_allowance -= batch_count
+        if admission_limit is not None:
+            admission_limit -= batch_count
+        if lag is not None and (max_lag is None or lag > max_lag):
+            max_lag = lag
+        if considered_count < limit:
+            break
+
+    if admission_limit is not None and admission_limit <= 0 and max_lag is None:
+        # Nobody got queued, but that doesn't mean nobody's waiting
+        oldest_due = db.users.find_one({"NextSynchronization": {"$lte": pass_start}, "QueuedAt": {"$exists": False}}, {"NextSynchronization": True}, sort=[("NextSynchronization", 1)])
+        if oldest_due:
+            max_lag = pass_start - oldest_due["NextSynchronization"]
+
+    if scheduled_count:
+        print("Scheduled %d users at %s (lag %s, took %s)" % (scheduled_count, datetime.utcnow(), max_lag, datetime.utcnow() - pass_start))
+    db.stats.update({}, {"$set": {
+                            "SchedulerLag": max_lag.total_seconds() if max_lag else 0,
+                            "SchedulerLastPassCount": scheduled_count,
+                            "SchedulerAdmissionLimited": admission_limit is not None and admission_limit <= 0,
+                            "SchedulerLastPassDuration": (datetime.utcnow() - pass_start).total_seconds(),
+                            "SchedulerUpdated": datetime.utcnow()}}, upsert=True)
 
     time.sleep(1)
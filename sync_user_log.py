@@ -0,0 +1,12 @@
+# Prints a user's recent sync logs - they're compressed segments in shared files now, so this (or the diagnostics page) is how to read them.
+# Usage: python3 sync_user_log.py <user ID> [count]
+from tapiriik.sync.user_logs import UserSyncLogSink
+from bson.objectid import ObjectId
+import sys
+
+user_id = ObjectId(sys.argv[1])
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+for sync_log in reversed(UserSyncLogSink.Read(user_id, count)):
+    print("==== %s UTC on %s ====" % (sync_log["Timestamp"], sync_log["Host"]))
+    print(sync_log["Log"])
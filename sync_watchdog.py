@@ -19,12 +19,17 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Has it been stalled for too long?
-    if worker["State"] == SyncStep.List:
-        timeout = timedelta(minutes=45)  # This can take a loooooooong time
-    else:
-        timeout = timedelta(minutes=10)  # But everything else shouldn't
+    def stalled(state, heartbeat):
+        if state == SyncStep.List:
+            timeout = timedelta(minutes=45)  # This can take a loooooooong time
+        else:
+            timeout = timedelta(minutes=10)  # But everything else shouldn't
+        return heartbeat < datetime.utcnow() - timeout
 
-    if alive and worker["Heartbeat"] < datetime.utcnow() - timeout:
+    # Workers running several syncs at once keep a heartbeat per user - any one of them getting stuck counts
+    stalled_tasks = [user for user, task in worker.get("Tasks", {}).items() if stalled(task["State"], task["Heartbeat"])]
+
+    if alive and (stalled(worker["State"], worker["Heartbeat"]) or stalled_tasks):
         print("%s timed out" % worker)
         os.kill(worker["Process"], signal.SIGKILL)
         alive = False
@@ -10,49 +10,31 @@ worker_message("booting")
 from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address
 from tapiriik import settings
 from tapiriik.database import db, close_connections
+from tapiriik.messagequeue import mq
 from pymongo import ReturnDocument
 import sys
 import subprocess
 import socket
+import signal
+import time
+import gc
 
-RecycleInterval = 2 # Time spent rebooting workers < time spent wrangling Python memory management.
+RecycleInterval = 2 # Time spent rebooting workers < time spent wrangling Python memory management. This is per concurrent sync slot.
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
 def sync_heartbeat(state, user=None):
-    db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
-
-worker_message("initialized")
-
-# Moved this flush before the sync_workers upsert for a rather convoluted reason:
-# Some of the sync servers were encountering filesystem corruption, causing the FS to be remounted as read-only.
-# Then, when a sync worker would start, it would insert a record in sync_workers then immediately die upon calling flush - since output is piped to a log file on the read-only FS.
-# Supervisor would dutifully restart the worker again and again, causing sync_workers to quickly fill up.
-# ...which is a problem, since it doesn't have indexes on Process or Host - what later lookups were based on. So, the database would be brought to a near standstill.
-# Theoretically, the watchdog would clean up these records soon enough - but since it too logs to a file, it would crash removing only a few stranded records
-# By flushing the logs before we insert, it should crash before filling that collection up.
-# (plus, we no longer query with Process/Host in sync_hearbeat)
-
-sys.stdout.flush()
-heartbeat_rec = db.sync_workers.find_one_and_update(
-	{
-		"Process": os.getpid(),
-		"Host": socket.gethostname()
-	}, { 
-		"$set": {
-			"Process": os.getpid(),
-			"Host": socket.gethostname(),
-			"Heartbeat": datetime.utcnow(),
-			"Startup":  datetime.utcnow(),
-			"Version": WorkerVersion,
-			"Index": settings.WORKER_INDEX,
-			"State": "startup"
-		}
-	}, upsert=True,
-	return_document=ReturnDocument.AFTER)
-heartbeat_rec_id = heartbeat_rec["_id"]
+    update = {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}}
+    if user:
+        # Each user being synchronized gets their own heartbeat too, so the watchdog can tell if any one of them is stuck
+        # "ready" means that user's sync is done with
+        if state == "ready":
+            update["$unset"] = {"Tasks.%s" % user: ""}
+        else:
+            update["$set"]["Tasks.%s" % user] = {"Heartbeat": datetime.utcnow(), "State": state}
+    db.sync_workers.update({"_id": heartbeat_rec_id}, update)
 
 patch_requests_with_default_timeout(timeout=60)
 
@@ -65,17 +47,120 @@ print(" %d -> Index %s\n -> Interface %s" % (os.getpid(), settings.WORKER_INDEX,
 # We defer including the main body of the application till here so the settings aren't captured before we've set them up.
 # The better way would be to defer initializing services until they're requested, but it's 10:30 and this will work just as well.
 from tapiriik.sync import Sync
+from tapiriik.sync.user_logs import UserSyncLogSink
+from tapiriik.services import Service, LazyService
 
-Sync.InitializeWorkerBindings()
-
-sync_heartbeat("ready")
-
-worker_message("ready")
+worker_message("initialized")
 
-Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval)
+def run_worker():
+    global heartbeat_rec_id
+    # Moved this flush before the sync_workers upsert for a rather convoluted reason:
+    # Some of the sync servers were encountering filesystem corruption, causing the FS to be remounted as read-only.
+    # Then, when a sync worker would start, it would insert a record in sync_workers then immediately die upon calling flush - since output is piped to a log file on the read-only FS.
+    # Supervisor would dutifully restart the worker again and again, causing sync_workers to quickly fill up.
+    # ...which is a problem, since it doesn't have indexes on Process or Host - what later lookups were based on. So, the database would be brought to a near standstill.
+    # Theoretically, the watchdog would clean up these records soon enough - but since it too logs to a file, it would crash removing only a few stranded records
+    # By flushing the logs before we insert, it should crash before filling that collection up.
+    # (plus, we no longer query with Process/Host in sync_hearbeat)
+
+    sys.stdout.flush()
+    heartbeat_rec = db.sync_workers.find_one_and_update(
+        {
+            "Process": os.getpid(),
+            "Host": socket.gethostname()
+        }, {
+            "$set": {
+                "Process": os.getpid(),
+                "Host": socket.gethostname(),
+                "Heartbeat": datetime.utcnow(),
+                "Startup":  datetime.utcnow(),
+                "Version": WorkerVersion,
+                "Index": settings.WORKER_INDEX,
+                "Concurrency": settings.SYNC_WORKER_CONCURRENCY,
+                "State": "startup"
+            }
+        }, upsert=True,
+        return_document=ReturnDocument.AFTER)
+    heartbeat_rec_id = heartbeat_rec["_id"]
+
+    Sync.InitializeWorkerBindings()
+
+    sync_heartbeat("ready")
+
+    worker_message("ready")
+
+    Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval * settings.SYNC_WORKER_CONCURRENCY, concurrency=settings.SYNC_WORKER_CONCURRENCY)
+
+    worker_message("shutting down cleanly")
+    db.sync_workers.remove({"_id": heartbeat_rec_id})
+    UserSyncLogSink.Flush()
+    close_connections()
+    worker_message("shut down")
+    sys.stdout.flush()
+
+if not settings.SYNC_WORKER_PROCESSES:
+    # The supervisor (the real one) restarts us after RecycleInterval users
+    run_worker()
+    sys.exit(0)
+
+# Otherwise, this process stays put with everything imported, and forks off the actual workers - replacing each after RecycleInterval users, without paying for another interpreter startup.
+# Nothing connected can be shared with the children, so the connections are dropped here and re-established in each (pymongo reconnects on its own)
+# Service adapters are normally only loaded when first used - but here, loading them up front means the workers all share the one copy
+for svc in Service.List():
+    if isinstance(svc, LazyService):
+        svc.Load()
 
-worker_message("shutting down cleanly")
-db.sync_workers.remove({"_id": heartbeat_rec_id})
 close_connections()
-worker_message("shut down")
-sys.stdout.flush()
+mq.release()
+
+# Everything imported so far lives as long as this process - leaving it out of the children's garbage collection means they don't touch (and so copy) those pages
+gc.collect()
+if hasattr(gc, "freeze"):
+    gc.freeze()
+
+worker_pids = set()
+
+def fork_worker():
+    pid = os.fork()
+    if pid:
+        worker_pids.add(pid)
+        return
+    exit_code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        mq.connect()
+        run_worker()
+        exit_code = 0
+    except:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip the parent's atexit handlers and the like - they're for the parent
+        os._exit(exit_code)
+
+def shutdown(signum, frame):
+    worker_message("stopping %d workers" % len(worker_pids))
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    sys.stdout.flush()
+    os._exit(0)
+
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGINT, shutdown)
+
+worker_message("forking %d workers" % settings.SYNC_WORKER_PROCESSES)
+
+while True:
+    while len(worker_pids) < settings.SYNC_WORKER_PROCESSES:
+        fork_worker()
+    pid, status = os.wait()
+    worker_pids.discard(pid)
+    if status:
+        worker_message("saw worker %d exit with status %d" % (pid, status))
+        time.sleep(1) # In case it's going to keep happening
@@ -17,6 +17,7 @@ import pytz
 import re
 import time
 import json
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +32,7 @@ class DailymileService(ServiceBase):
     UserProfileURL = "http://www.dailymile.com/people/{0}"
     AuthenticationNoFrame = True  # They don't prevent the iframe, it just looks really ugly.
     LastUpload = None
+    _uploadCooldownLock = threading.Lock()
 
     SupportsHR = True
 
@@ -236,13 +238,19 @@ class DailymileService(ServiceBase):
 #
 #        return activity
 
+    def _waitForUploadCooldown(self):
+        # LastUpload is shared by every thread uploading in this process - so it's claimed under the lock once the cooldown's up, or two could go back to back
+        with DailymileService._uploadCooldownLock:
+            if self.LastUpload is not None:
+                while (datetime.now() - self.LastUpload).total_seconds() < 5:
+                    time.sleep(1)
+                    logger.debug("Inter-upload cooldown")
+            self.LastUpload = datetime.now()
+
     def UploadActivity(self, serviceRecord, activity):
         logger.info("Activity tz " + str(activity.TZ) + " dt tz " + str(activity.StartTime.tzinfo) + " starttime " + str(activity.StartTime))
 
-        if self.LastUpload is not None:
-            while (datetime.now() - self.LastUpload).total_seconds() < 5:
-                time.sleep(1)
-                logger.debug("Inter-upload cooldown")
+        self._waitForUploadCooldown()
         source_svc = None
         if hasattr(activity, "ServiceDataCollection"):
             source_svc = str(list(activity.ServiceDataCollection.keys())[0])
@@ -1,4 +1,4 @@
-from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
+from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, GARMIN_CONNECT_USER_WATCH_ACCOUNTS, GARMIN_CONNECT_ACTIVITY_HIERARCHY_SNAPSHOT
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
@@ -23,6 +23,7 @@ import json
 import re
 import random
 import tempfile
+import threading
 import json
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
@@ -120,22 +121,30 @@ class GarminConnectService(ServiceBase):
         "Referer": "https://sync.tapiriik.com"
     }
 
+    # The activity type hierarchy hardly ever changes, so rather than every process asking for it at startup, it's kept on disk and refreshed in the background once it's this old
+    _activityHierarchySnapshotVersion = 1
+    _activityHierarchyRefreshInterval = timedelta(days=7)
+
     def __init__(self):
-        cachedHierarchy = cachedb.gc_type_hierarchy.find_one()
-        if not cachedHierarchy:
-            rawHierarchy = requests.get("https://connect.garmin.com/proxy/activity-service-1.2/json/activity_types", headers=self._obligatory_headers).text
-            self._activityHierarchy = json.loads(rawHierarchy)["dictionary"]
-            cachedb.gc_type_hierarchy.insert({"Hierarchy": rawHierarchy})
-        else:
-            self._activityHierarchy = json.loads(cachedHierarchy["Hierarchy"])["dictionary"]
-        rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % HTTP_SOURCE_ADDR
-        # Ensure the rate lock file exists (...the easy way)
-        open(rate_lock_path, "a").close()
-        self._rate_lock = open(rate_lock_path, "r+")
+        self._activityHierarchyCache = None
+        self._activityHierarchyLock = threading.Lock()
+        self._activityHierarchyRefreshing = False
+        self._rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % HTTP_SOURCE_ADDR
+        # Opened on first use, by each process - flock() locks belong to the open file, so one opened before a fork (say, by the prefork sync worker parent) wouldn't exclude anything between the children
+        self._rate_lock = None
+        self._rate_lock_pid = None
+        self._rate_thread_lock = threading.Lock()
 
     def _rate_limit(self):
         import fcntl, struct, time
         min_period = 1  # I appear to been banned from Garmin Connect while determining this.
+        # flock() doesn't exclude other threads using the same file, and sync workers can have several going
+        self._rate_thread_lock.acquire()
+        if self._rate_lock_pid != os.getpid():
+            # Ensure the rate lock file exists (...the easy way)
+            open(self._rate_lock_path, "a").close()
+            self._rate_lock = open(self._rate_lock_path, "r+")
+            self._rate_lock_pid = os.getpid()
         fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
         try:
             self._rate_lock.seek(0)
@@ -153,6 +162,7 @@ class GarminConnectService(ServiceBase):
             self._rate_lock.flush()
         finally:
             fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+            self._rate_thread_lock.release()
 
     def _request_with_reauth(self, req_lambda, serviceRecord=None, email=None, password=None):
         for i in range(self._reauthAttempts + 1):
@@ -275,6 +285,68 @@ class GarminConnectService(ServiceBase):
     def UserUploadedActivityURL(self, uploadId):
         return "https://connect.garmin.com/modern/activity/%d" % uploadId
 
+    @property
+    def _activityHierarchy(self):
+        if self._activityHierarchyCache is None:
+            with self._activityHierarchyLock:
+                if self._activityHierarchyCache is None:
+                    self._loadActivityHierarchy()
+        return self._activityHierarchyCache
+
+    def _loadActivityHierarchy(self):
+        snapshot = None
+        try:
+            with open(GARMIN_CONNECT_ACTIVITY_HIERARCHY_SNAPSHOT, "r") as snapshotFile:
+                snapshot = json.load(snapshotFile)
+            if snapshot.get("Version") != self._activityHierarchySnapshotVersion:
+                snapshot = None
+        except (IOError, ValueError):
+            pass
+        if snapshot:
+            self._activityHierarchyCache = json.loads(snapshot["Hierarchy"])["dictionary"]
+            if datetime.utcnow() - datetime.strptime(snapshot["Timestamp"], "%Y-%m-%dT%H:%M:%S") > self._activityHierarchyRefreshInterval:
+                self._refreshActivityHierarchyInBackground()
+            return
+        # No snapshot on this host yet - another may have left a copy in the cache, otherwise there's no avoiding asking for it now
+        cachedHierarchy = cachedb.gc_type_hierarchy.find_one()
+        if cachedHierarchy:
+            rawHierarchy = cachedHierarchy["Hierarchy"]
+            self._activityHierarchyCache = json.loads(rawHierarchy)["dictionary"]
+            self._writeActivityHierarchySnapshot(rawHierarchy, cachedHierarchy.get("Timestamp", datetime.utcnow()))
+        else:
+            self._refreshActivityHierarchy()
+
+    def _refreshActivityHierarchy(self):
+        rawHierarchy = requests.get("https://connect.garmin.com/proxy/activity-service-1.2/json/activity_types", headers=self._obligatory_headers).text
+        self._activityHierarchyCache = json.loads(rawHierarchy)["dictionary"]
+        fetched = datetime.utcnow()
+        cachedb.gc_type_hierarchy.update({}, {"Hierarchy": rawHierarchy, "Timestamp": fetched}, upsert=True)
+        self._writeActivityHierarchySnapshot(rawHierarchy, fetched)
+
+    def _refreshActivityHierarchyInBackground(self):
+        if self._activityHierarchyRefreshing:
+            return
+        self._activityHierarchyRefreshing = True
+        def _refresh():
+            try:
+                self._refreshActivityHierarchy()
+            except Exception:
+                # The snapshot we have will do in the meantime
+                logger.exception("Could not refresh GC activity type hierarchy")
+            finally:
+                self._activityHierarchyRefreshing = False
+        threading.Thread(target=_refresh, name="gc-activity-hierarchy", daemon=True).start()
+
+    def _writeActivityHierarchySnapshot(self, rawHierarchy, fetched):
+        # Written alongside then moved into place, so other processes never see half of it
+        snapshotDir = os.path.dirname(os.path.abspath(GARMIN_CONNECT_ACTIVITY_HIERARCHY_SNAPSHOT))
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=snapshotDir, delete=False) as snapshotFile:
+                json.dump({"Version": self._activityHierarchySnapshotVersion, "Timestamp": fetched.strftime("%Y-%m-%dT%H:%M:%S"), "Hierarchy": rawHierarchy}, snapshotFile)
+            os.replace(snapshotFile.name, GARMIN_CONNECT_ACTIVITY_HIERARCHY_SNAPSHOT)
+        except OSError:
+            logger.exception("Could not write GC activity type hierarchy snapshot")
+
     def _resolveActivityType(self, act_type):
         # Mostly there are two levels of a hierarchy, so we don't really need this as the parent is included in the listing.
         # But maybe they'll change that some day?
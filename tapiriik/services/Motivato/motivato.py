@@ -12,6 +12,8 @@ import logging
 import time
 import json
 import tempfile
+import os
+import threading
 logger = logging.getLogger(__name__)
 
 class MotivatoService(ServiceBase):
@@ -60,10 +62,11 @@ class MotivatoService(ServiceBase):
     _urlRoot = "http://motivato.pl"
 
     def __init__(self):
-        rate_lock_path = tempfile.gettempdir() + "/m_rate.%s.lock" % HTTP_SOURCE_ADDR
-        # Ensure the rate lock file exists (...the easy way)
-        open(rate_lock_path, "a").close()
-        self._rate_lock = open(rate_lock_path, "r+")
+        self._rate_lock_path = tempfile.gettempdir() + "/m_rate.%s.lock" % HTTP_SOURCE_ADDR
+        # Opened on first use, by each process - flock() locks belong to the open file, so one opened before a fork (say, by the prefork sync worker parent) wouldn't exclude anything between the children
+        self._rate_lock = None
+        self._rate_lock_pid = None
+        self._rate_thread_lock = threading.Lock()
 
     def WebInit(self):
         self.UserAuthorizationURL = WEB_ROOT + reverse("auth_simple", kwargs={"service": self.ID})
@@ -351,6 +354,13 @@ class MotivatoService(ServiceBase):
         import fcntl, time
         min_period = 1
         print("Waiting for lock")
+        # flock() doesn't exclude other threads using the same file, and sync workers can have several going
+        self._rate_thread_lock.acquire()
+        if self._rate_lock_pid != os.getpid():
+            # Ensure the rate lock file exists (...the easy way)
+            open(self._rate_lock_path, "a").close()
+            self._rate_lock = open(self._rate_lock_path, "r+")
+            self._rate_lock_pid = os.getpid()
         fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
         try:
             print("Have lock")
@@ -371,6 +381,7 @@ class MotivatoService(ServiceBase):
             print("Rate limited for %f" % wait_time)
         finally:
             fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+            self._rate_thread_lock.release()
 
     def DeleteCachedData(self, serviceRecord):
         # nothing cached...
@@ -225,8 +225,6 @@ class NikePlusService(ServiceBase):
         lap = Lap(startTime=activity.StartTime, endTime=activity.EndTime)
         lap.Stats = activity.Stats
         activity.Laps = [lap]
-        # I thought I wrote StreamSampler to be generator-friendly - nope.
-        streams = {k: list(v) for k,v in streams.items()}
 
         # The docs are unclear on which of these are actually stream metrics, oh well
         def stream_waypoint(offset, speed=None, distance=None, heartrate=None, calories=None, steps=None, watts=None, gps=None, **kwargs):
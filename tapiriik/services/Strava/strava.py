@@ -17,6 +17,7 @@ import pytz
 import re
 import time
 import json
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,7 @@ class StravaService(ServiceBase):
     AuthenticationNoFrame = True  # They don't prevent the iframe, it just looks really ugly.
     PartialSyncRequiresTrigger = True
     LastUpload = None
+    _uploadCooldownLock = threading.Lock()
 
     SupportsHR = SupportsCadence = SupportsTemp = SupportsPower = True
 
@@ -300,13 +302,19 @@ class StravaService(ServiceBase):
 
         return activity
 
+    def _waitForUploadCooldown(self):
+        # LastUpload is shared by every thread uploading in this process - so it's claimed under the lock once the cooldown's up, or two could go back to back
+        with StravaService._uploadCooldownLock:
+            if self.LastUpload is not None:
+                while (datetime.now() - self.LastUpload).total_seconds() < 5:
+                    time.sleep(1)
+                    logger.debug("Inter-upload cooldown")
+            self.LastUpload = datetime.now()
+
     def UploadActivity(self, serviceRecord, activity):
         logger.info("Activity tz " + str(activity.TZ) + " dt tz " + str(activity.StartTime.tzinfo) + " starttime " + str(activity.StartTime))
 
-        if self.LastUpload is not None:
-            while (datetime.now() - self.LastUpload).total_seconds() < 5:
-                time.sleep(1)
-                logger.debug("Inter-upload cooldown")
+        self._waitForUploadCooldown()
         source_svc = None
         if hasattr(activity, "ServiceDataCollection"):
             source_svc = str(list(activity.ServiceDataCollection.keys())[0])
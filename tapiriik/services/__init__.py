@@ -1,43 +1,26 @@
 from .service_base import *
 from .api import *
-from tapiriik.services.RunKeeper import RunKeeperService
-RunKeeper = RunKeeperService()
-from tapiriik.services.Strava import StravaService
-Strava = StravaService()
-from tapiriik.services.Endomondo import EndomondoService
-Endomondo = EndomondoService()
-from tapiriik.services.Dropbox import DropboxService
-Dropbox = DropboxService()
-from tapiriik.services.GarminConnect import GarminConnectService
-GarminConnect = GarminConnectService()
-from tapiriik.services.SportTracks import SportTracksService
-SportTracks = SportTracksService()
-from tapiriik.services.RideWithGPS import RideWithGPSService
-RideWithGPS = RideWithGPSService()
-from tapiriik.services.TrainAsONE import TrainAsONEService
-TrainAsONE = TrainAsONEService()
-from tapiriik.services.TrainingPeaks import TrainingPeaksService
-TrainingPeaks = TrainingPeaksService()
-from tapiriik.services.Motivato import MotivatoService
-Motivato = MotivatoService()
-from tapiriik.services.NikePlus import NikePlusService
-NikePlus = NikePlusService()
-from tapiriik.services.VeloHero import VeloHeroService
-VeloHero = VeloHeroService()
-from tapiriik.services.TrainerRoad import TrainerRoadService
-TrainerRoad = TrainerRoadService()
-from tapiriik.services.Smashrun import SmashrunService
-Smashrun = SmashrunService()
-from tapiriik.services.BeginnerTriathlete import BeginnerTriathleteService
-BeginnerTriathlete = BeginnerTriathleteService()
-from tapiriik.services.Pulsstory import PulsstoryService
-Pulsstory = PulsstoryService()
-from tapiriik.services.Setio import SetioService
-Setio = SetioService()
-from tapiriik.services.Singletracker import SingletrackerService
-Singletracker = SingletrackerService()
-from tapiriik.services.Dailymile import DailymileService
-Dailymile = DailymileService()
+from .lazy_service import LazyService
+# Each adapter is only imported (and instantiated) when something first needs it - see LazyService
+RunKeeper = LazyService("runkeeper", "tapiriik.services.RunKeeper", "RunKeeperService")
+Strava = LazyService("strava", "tapiriik.services.Strava", "StravaService")
+Endomondo = LazyService("endomondo", "tapiriik.services.Endomondo", "EndomondoService")
+Dropbox = LazyService("dropbox", "tapiriik.services.Dropbox", "DropboxService")
+GarminConnect = LazyService("garminconnect", "tapiriik.services.GarminConnect", "GarminConnectService")
+SportTracks = LazyService("sporttracks", "tapiriik.services.SportTracks", "SportTracksService")
+RideWithGPS = LazyService("rwgps", "tapiriik.services.RideWithGPS", "RideWithGPSService")
+TrainAsONE = LazyService("trainasone", "tapiriik.services.TrainAsONE", "TrainAsONEService")
+TrainingPeaks = LazyService("trainingpeaks", "tapiriik.services.TrainingPeaks", "TrainingPeaksService")
+Motivato = LazyService("motivato", "tapiriik.services.Motivato", "MotivatoService")
+NikePlus = LazyService("nikeplus", "tapiriik.services.NikePlus", "NikePlusService")
+VeloHero = LazyService("velohero", "tapiriik.services.VeloHero", "VeloHeroService")
+TrainerRoad = LazyService("trainerroad", "tapiriik.services.TrainerRoad", "TrainerRoadService")
+Smashrun = LazyService("smashrun", "tapiriik.services.Smashrun", "SmashrunService")
+BeginnerTriathlete = LazyService("beginnertriathlete", "tapiriik.services.BeginnerTriathlete", "BeginnerTriathleteService")
+Pulsstory = LazyService("pulsstory", "tapiriik.services.Pulsstory", "PulsstoryService")
+Setio = LazyService("setio", "tapiriik.services.Setio", "SetioService")
+Singletracker = LazyService("singletracker", "tapiriik.services.Singletracker", "SingletrackerService")
+Dailymile = LazyService("dailymile", "tapiriik.services.Dailymile", "DailymileService")
 
 PRIVATE_SERVICES = []
 try:
@@ -1,4 +1,6 @@
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
+from array import array
+from collections.abc import MutableSequence
 from tapiriik.database import cachedb
 from tapiriik.database.tz import TZLookup
 import hashlib
@@ -91,6 +93,18 @@ class Activity:
     def GetFlatWaypoints(self):
         return [wp for waypoints in [x.Waypoints for x in self.Laps] for wp in waypoints]
 
+    def GetFlatWaypointColumn(self, field):
+        """ The given field of every waypoint, as an array of floats (see WaypointColumns.Column) - cheaper than going through GetFlatWaypoints, once compacted """
+        column = array("d")
+        for lap in self.Laps:
+            column.extend(lap.Waypoints.Column(field))
+        return column
+
+    def CompactWaypoints(self):
+        """ Moves the waypoints into columnar storage (see WaypointStore) - for once they're done being built up """
+        for lap in self.Laps:
+            lap.Waypoints.Compact()
+
     def GetFirstWaypointWithLocation(self):
         loc_wp = None
         for lap in self.Laps:
@@ -385,6 +399,15 @@ class Lap:
         self.Stats = stats if stats else ActivityStatistics()
         self.Waypoints = waypointList if waypointList else []
 
+    @property
+    def Waypoints(self):
+        return self._waypoints
+
+    @Waypoints.setter
+    def Waypoints(self, waypoints):
+        # Adapters are welcome to assign plain lists
+        self._waypoints = waypoints if isinstance(waypoints, WaypointStore) else WaypointStore(waypoints)
+
     def __str__(self):
         return str(self.StartTime) + "-" + str(self.EndTime) + " " + str(self.Intensity) + " (" + str(self.Trigger) + ") " + str(len(self.Waypoints)) + " wps"
     __repr__ = __str__
@@ -654,3 +677,365 @@ class Location:
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+class WaypointColumns:
+    """ A run of waypoints kept as parallel arrays - one per field - instead of a Waypoint (and Location) object apiece, for WaypointStore.
+        Rows are read and written through WaypointView/LocationView. Any row that won't fit in the columns (odd value types, Waypoint subclasses, etc.) just keeps its object.
+    """
+    NumericFields = ["HR", "Calories", "Power", "Temp", "Cadence", "RunCadence", "Distance", "Speed", "Type", "Latitude", "Longitude", "Altitude"]
+    LocationFields = ["Latitude", "Longitude", "Altitude"]
+
+    # What the value in each row of a numeric column originally was - so ints come back out as ints
+    _none = 0
+    _float = 1
+    _int = 2
+
+    _epoch = datetime(1970, 1, 1)
+    _microsecond = timedelta(microseconds=1)
+    _noTimestamp = -2 ** 63
+
+    def __init__(self):
+        self._length = 0
+        self._values = dict((field, array("d")) for field in WaypointColumns.NumericFields)
+        self._kinds = dict((field, bytearray()) for field in WaypointColumns.NumericFields)
+        self._hasLocation = bytearray()
+        # Timestamps are stored as (naive) microseconds since the epoch, plus an index into the tzinfos seen - so the exact same tzinfo object comes back out
+        self._timestamps = array("q")
+        self._timezoneIndices = array("I")
+        self._timezones = [None]
+        self._objects = {}
+        self._materialized = None
+
+    def __len__(self):
+        return self._length
+
+    def _kind(value):
+        if value is None:
+            return WaypointColumns._none
+        if type(value) is float:
+            return WaypointColumns._float
+        if type(value) is int and -2 ** 53 <= value <= 2 ** 53:
+            return WaypointColumns._int
+        return None
+
+    def _fits(wp):
+        if type(wp) is not Waypoint:
+            return False
+        if wp.Timestamp is not None and (type(wp.Timestamp) is not datetime or wp.Timestamp.fold):
+            return False
+        if wp.Location is not None and type(wp.Location) is not Location:
+            return False
+        for field in WaypointColumns.NumericFields:
+            if WaypointColumns._kind(WaypointColumns._fieldValue(wp, field)) is None:
+                return False
+        return True
+
+    def _fieldValue(wp, field):
+        if field in WaypointColumns.LocationFields:
+            return getattr(wp.Location, field) if wp.Location is not None else None
+        return getattr(wp, field)
+
+    def _columnValue(wp, field):
+        value = WaypointColumns._fieldValue(wp, field)
+        if value is None:
+            return float("nan")
+        if field == "Timestamp":
+            return WaypointColumns._timestampSeconds(value)
+        return float(value)
+
+    def _timestampSeconds(timestamp):
+        offset = timestamp.utcoffset() or timedelta(0)
+        return (timestamp.replace(tzinfo=None) - offset - WaypointColumns._epoch) / timedelta(seconds=1)
+
+    def Extend(self, waypoints):
+        """ Appends these waypoints' values - the objects themselves aren't kept (unless they don't fit) """
+        nan = float("nan")
+        for wp in waypoints:
+            row = self._length
+            self._length += 1
+            self._hasLocation.append(0)
+            self._timestamps.append(WaypointColumns._noTimestamp)
+            self._timezoneIndices.append(0)
+            for field in WaypointColumns.NumericFields:
+                self._values[field].append(nan)
+                self._kinds[field].append(WaypointColumns._none)
+            if WaypointColumns._fits(wp):
+                self._setTimestamp(row, wp.Timestamp)
+                if wp.Location is not None:
+                    self._hasLocation[row] = 1
+                for field in WaypointColumns.NumericFields:
+                    self._setValue(row, field, WaypointColumns._fieldValue(wp, field))
+            else:
+                self._objects[row] = wp
+
+    def _object(self, row):
+        if self._materialized is not None:
+            return self._materialized[row]
+        return self._objects.get(row, None) if self._objects else None
+
+    def _setTimestamp(self, row, timestamp):
+        if timestamp is None:
+            self._timestamps[row] = WaypointColumns._noTimestamp
+            self._timezoneIndices[row] = 0
+            return
+        tz = timestamp.tzinfo
+        for index, known in enumerate(self._timezones):
+            if known is tz:
+                break
+        else:
+            index = len(self._timezones)
+            self._timezones.append(tz)
+        self._timestamps[row] = (timestamp.replace(tzinfo=None) - WaypointColumns._epoch) // WaypointColumns._microsecond
+        self._timezoneIndices[row] = index
+
+    def _setValue(self, row, field, value):
+        kind = WaypointColumns._kind(value)
+        self._values[field][row] = float("nan") if value is None else value
+        self._kinds[field][row] = kind
+
+    def Get(self, row, field):
+        obj = self._object(row)
+        if obj is not None:
+            return WaypointColumns._fieldValue(obj, field)
+        if field == "Timestamp":
+            micros = self._timestamps[row]
+            if micros == WaypointColumns._noTimestamp:
+                return None
+            timestamp = WaypointColumns._epoch + timedelta(microseconds=micros)
+            tz = self._timezones[self._timezoneIndices[row]]
+            return timestamp.replace(tzinfo=tz) if tz is not None else timestamp
+        if field == "Location":
+            return LocationView(self, row) if self._hasLocation[row] else None
+        kind = self._kinds[field][row]
+        if kind == WaypointColumns._none:
+            return None
+        value = self._values[field][row]
+        return int(value) if kind == WaypointColumns._int else value
+
+    def Set(self, row, field, value):
+        obj = self._object(row)
+        if obj is not None:
+            if field in WaypointColumns.LocationFields:
+                if obj.Location is not None:
+                    setattr(obj.Location, field, value)
+            else:
+                setattr(obj, field, value)
+            return
+        if field == "Timestamp":
+            if value is None or (type(value) is datetime and not value.fold):
+                self._setTimestamp(row, value)
+                return
+        elif field == "Location":
+            if value is None:
+                self._hasLocation[row] = 0
+                for locField in WaypointColumns.LocationFields:
+                    self._setValue(row, locField, None)
+                return
+            if type(value) is Location and all(WaypointColumns._kind(getattr(value, locField)) is not None for locField in WaypointColumns.LocationFields):
+                self._hasLocation[row] = 1
+                for locField in WaypointColumns.LocationFields:
+                    self._setValue(row, locField, getattr(value, locField))
+                return
+        elif WaypointColumns._kind(value) is not None:
+            self._setValue(row, field, value)
+            return
+        # Doesn't fit - this row gets a Waypoint of its own from here on
+        self._objects[row] = self._row(row)
+        self.Set(row, field, value)
+
+    def _row(self, row):
+        obj = self._object(row)
+        if obj is not None:
+            return obj
+        wp = Waypoint(timestamp=self.Get(row, "Timestamp"), ptType=self.Get(row, "Type"), hr=self.Get(row, "HR"), power=self.Get(row, "Power"), calories=self.Get(row, "Calories"), cadence=self.Get(row, "Cadence"), runCadence=self.Get(row, "RunCadence"), temp=self.Get(row, "Temp"), distance=self.Get(row, "Distance"), speed=self.Get(row, "Speed"))
+        if self._hasLocation[row]:
+            wp.Location = Location(self.Get(row, "Latitude"), self.Get(row, "Longitude"), self.Get(row, "Altitude"))
+        return wp
+
+    def Materialize(self):
+        """ Turns every row back into a Waypoint object, and returns them. Views handed out beforehand carry on working, via these objects """
+        if self._materialized is None:
+            self._materialized = [self._row(row) for row in range(self._length)]
+            self._values = self._kinds = self._hasLocation = self._timestamps = self._timezoneIndices = None
+            self._objects = {}
+        return self._materialized
+
+    def Column(self, field):
+        """ The given field (any numeric field, or Timestamp - as POSIX seconds) for each row, as an array of floats, with NaN standing in for None """
+        if self._materialized is not None:
+            return array("d", (WaypointColumns._columnValue(wp, field) for wp in self._materialized))
+        if field == "Timestamp":
+            column = array("d", [float("nan")]) * self._length
+            # Most tzinfos have a fixed offset (pytz's are one per offset) - no need to construct each datetime to find it
+            offsets = [0 if tz is None else (tz.utcoffset(WaypointColumns._epoch.replace(tzinfo=tz)) // WaypointColumns._microsecond if isinstance(tz, (pytz.tzinfo.BaseTzInfo, timezone)) else None) for tz in self._timezones]
+            timestamps = self._timestamps
+            timezoneIndices = self._timezoneIndices
+            for row in range(self._length):
+                micros = timestamps[row]
+                if micros == WaypointColumns._noTimestamp:
+                    continue
+                offset = offsets[timezoneIndices[row]]
+                if offset is None:
+                    column[row] = WaypointColumns._timestampSeconds(self.Get(row, "Timestamp"))
+                else:
+                    column[row] = (micros - offset) / 1000000
+        else:
+            column = array("d", self._values[field])
+        for row, obj in self._objects.items():
+            column[row] = WaypointColumns._columnValue(obj, field)
+        return column
+
+
+class WaypointView(Waypoint):
+    """ A row of a WaypointColumns, standing in for the Waypoint object it replaced - reads and writes go straight to the columns """
+    __slots__ = ["_columns", "_row"]
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    def Detach(self):
+        """ A plain Waypoint copy of this row """
+        wp = Waypoint(timestamp=self.Timestamp, ptType=self.Type, hr=self.HR, power=self.Power, calories=self.Calories, cadence=self.Cadence, runCadence=self.RunCadence, temp=self.Temp, distance=self.Distance, speed=self.Speed)
+        loc = self.Location
+        wp.Location = Location(loc.Latitude, loc.Longitude, loc.Altitude) if isinstance(loc, LocationView) else loc
+        return wp
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are of the waypoint, not the whole column store
+        return self.Detach().__reduce_ex__(protocol)
+
+
+class LocationView(Location):
+    """ The Location of a row of a WaypointColumns """
+    __slots__ = ["_columns", "_row"]
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    def __reduce_ex__(self, protocol):
+        return Location(self.Latitude, self.Longitude, self.Altitude).__reduce_ex__(protocol)
+
+
+def _columnProperty(field):
+    return property(lambda self: self._columns.Get(self._row, field), lambda self, value: self._columns.Set(self._row, field, value))
+
+for _field in Waypoint.__slots__:
+    setattr(WaypointView, _field, _columnProperty(_field))
+for _field in Location.__slots__:
+    setattr(LocationView, _field, _columnProperty(_field))
+
+
+class WaypointStore(MutableSequence):
+    """ What Lap.Waypoints holds - it behaves like a list of Waypoints, and adapters can carry on treating it as one.
+        Waypoints are appended as regular objects, until Compact() moves them into a WaypointColumns: from then on, indexing and iteration give WaypointViews onto it, and Column() can read a field's values without any per-waypoint objects at all.
+        So, Compact() once the waypoints are done being built up - changes to the original objects after that aren't picked up.
+        Inserting, removing, replacing or reordering compacted waypoints turns them back into objects first, so it's best avoided on large activities.
+    """
+    def __init__(self, waypoints=None):
+        self._columns = None
+        # Adopting the list (rather than copying it) means anything appended to it later is still seen, as with plain lists
+        self._pending = waypoints if isinstance(waypoints, list) else list(waypoints or [])
+
+    def _compactedLength(self):
+        return len(self._columns) if self._columns is not None else 0
+
+    def _expand(self):
+        if self._columns is not None:
+            self._pending = self._columns.Materialize() + self._pending
+            self._columns = None
+
+    def Compact(self):
+        if self._pending:
+            if self._columns is None:
+                self._columns = WaypointColumns()
+            self._columns.Extend(self._pending)
+            self._pending = []
+
+    def Column(self, field):
+        """ See WaypointColumns.Column """
+        column = self._columns.Column(field) if self._columns is not None else array("d")
+        column.extend(WaypointColumns._columnValue(wp, field) for wp in self._pending)
+        return column
+
+    def __len__(self):
+        return self._compactedLength() + len(self._pending)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        compacted = self._compactedLength()
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= compacted + len(self._pending):
+            raise IndexError("waypoint index out of range")
+        if index < compacted:
+            return WaypointView(self._columns, index)
+        return self._pending[index - compacted]
+
+    def __iter__(self):
+        columns = self._columns
+        if columns is not None:
+            for row in range(len(columns)):
+                yield WaypointView(columns, row)
+        yield from self._pending
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice) or index < 0 or index < self._compactedLength():
+            self._expand()
+            self._pending[index] = value
+        else:
+            self._pending[index - self._compactedLength()] = value
+
+    def __delitem__(self, index):
+        if isinstance(index, slice) or index < 0 or index < self._compactedLength():
+            self._expand()
+            del self._pending[index]
+        else:
+            del self._pending[index - self._compactedLength()]
+
+    def insert(self, index, value):
+        if index < 0:
+            index = max(0, index + len(self))
+        compacted = self._compactedLength()
+        if index >= compacted:
+            self._pending.insert(index - compacted, value)
+        else:
+            self._expand()
+            self._pending.insert(index, value)
+
+    def append(self, value):
+        self._pending.append(value)
+
+    def extend(self, values):
+        self._pending.extend(values)
+
+    def clear(self):
+        self._columns = None
+        self._pending = []
+
+    def sort(self, *args, **kwargs):
+        self._expand()
+        self._pending.sort(*args, **kwargs)
+
+    def reverse(self):
+        self._expand()
+        self._pending.reverse()
+
+    def copy(self):
+        return list(self)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, WaypointStore)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __str__(self):
+        return str(list(self))
+    __repr__ = __str__
@@ -0,0 +1,43 @@
+import importlib
+import sys
+import threading
+
+class LazyService:
+    """ Stands in for a service adapter until something actually needs it - then imports and instantiates it, and passes everything through.
+        The ID (and any IDAliases) are known up front, so Service.FromID etc. don't count as needing it.
+    """
+    _loadLock = threading.RLock()
+
+    def __init__(self, id, module, class_name, id_aliases=None):
+        object.__setattr__(self, "ID", id)
+        object.__setattr__(self, "IDAliases", id_aliases)
+        object.__setattr__(self, "_module", module)
+        object.__setattr__(self, "_className", class_name)
+        object.__setattr__(self, "_instance", None)
+
+    def Load(self):
+        """ Returns the adapter itself, importing it if need be """
+        if self._instance is None:
+            with LazyService._loadLock:
+                if self._instance is None:
+                    package, attr = self._module.rsplit(".", 1)
+                    instance = getattr(importlib.import_module(self._module), self._className)()
+                    if instance.ID != self.ID:
+                        raise ValueError("Service %s.%s has ID %s, not %s" % (self._module, self._className, instance.ID, self.ID))
+                    # Importing the adapter's package replaces us in tapiriik.services with it
+                    if getattr(sys.modules[package], attr, None) is sys.modules[self._module]:
+                        setattr(sys.modules[package], attr, self)
+                    object.__setattr__(self, "_instance", instance)
+        return self._instance
+
+    def __getattr__(self, name):
+        # Only called for what's not set above - and not worth loading the adapter for protocol lookups (copy, pickle, etc.)
+        if name.startswith("__") or name in ("_instance", "_module", "_className"):
+            raise AttributeError(name)
+        return getattr(self.Load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.Load(), name, value)
+
+    def __repr__(self):
+        return "<LazyService %s%s>" % (self.ID, "" if self._instance is None else " (loaded)")
@@ -94,7 +94,7 @@ class Service:
         # Should really figure out how to mangle pymongo into doing the serialization for me...
         extendedAuthDetailsForStorage = CredentialStore.FlattenShadowedCredentials(extendedAuthDetails) if extendedAuthDetails else None
         if serviceRecord is None:
-            db.connections.insert({"ExternalID": uid, "Service": service.ID, "SynchronizedActivities": [], "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
+            db.connections.insert({"ExternalID": uid, "Service": service.ID, "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
             serviceRecord = ServiceRecord(db.connections.find_one({"ExternalID": uid, "Service": service.ID}))
             serviceRecord.ExtendedAuthorization = extendedAuthDetails # So SubscribeToPartialSyncTrigger can use it (we don't save the whole record after this point)
             if service.PartialSyncTriggerRequiresPolling:
@@ -132,5 +132,6 @@ class Service:
         svc.RevokeAuthorization(serviceRecord)
         cachedb.extendedAuthDetails.remove({"ID": serviceRecord._id})
         db.connections.remove({"_id": serviceRecord._id})
+        db.synchronized_activities.remove({"ConnectionID": serviceRecord._id})
 
 Service.Init()
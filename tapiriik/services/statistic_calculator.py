@@ -1,104 +1,199 @@
 from datetime import timedelta
 from .interchange import WaypointType
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class ActivityStatisticCalculator:
+    """ Works out statistics from an activity's waypoints, for when the source service doesn't provide them.
+        The waypoints are read a field at a time (see Activity.GetFlatWaypointColumn), and crunched with NumPy if it's installed - or plain Python loops otherwise, with the same results.
+    """
     ImplicitPauseTime = timedelta(minutes=1, seconds=5)
+    # Below this speed (m/s), time spent isn't counted as moving time
+    MovingSpeedThreshold = 0.5
 
     def CalculateDistance(act, startWpt=None, endWpt=None):
-        import math
-        dist = 0
-        altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
-        lastTimestamp = lastLoc = None
-
-        flatWaypoints = act.GetFlatWaypoints()
-
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            timeDelta = flatWaypoints[x].Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = flatWaypoints[x].Timestamp
-
-            if flatWaypoints[x].Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
-                lastLoc = None  # don't count distance while paused
-                continue
-
-            loc = flatWaypoints[x].Location
-            if loc is None or loc.Longitude is None or loc.Latitude is None:
-                # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
-                continue
-
-            if loc and lastLoc:
-                altHold = lastLoc.Altitude if lastLoc.Altitude is not None else altHold
-                latRads = loc.Latitude * math.pi / 180
-                meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
-                meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
-                dx = (loc.Longitude - lastLoc.Longitude) * meters_lon_degree
-                dy = (loc.Latitude - lastLoc.Latitude) * meters_lat_degree
-                if loc.Altitude is not None and altHold is not None:  # incorporate the altitude when possible
-                    dz = loc.Altitude - altHold
-                else:
-                    dz = 0
-                dist += math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
-            lastLoc = loc
-
-        return dist
+        return ActivityStatisticCalculator._summarize(act, startWpt, endWpt, distance=True)["Distance"]
 
     def CalculateTimerTime(act, startWpt=None, endWpt=None):
-        flatWaypoints = []
-        for lap in act.Laps:
-            flatWaypoints.append(lap.Waypoints)
-
-        if len(flatWaypoints) < 3:
+        if act.CountTotalWaypoints() < 3:
             # Either no waypoints, or one at the start and one at the end
             raise ValueError("Not enough waypoints to calculate timer time")
-        duration = timedelta(0)
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-        lastTimestamp = None
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = wpt.Timestamp
-            if wpt.Type is WaypointType.Pause:
-                lastTimestamp = None
-            elif delta and delta > act.ImplicitPauseTime:
-                delta = None  # Implicit pauses
-            if delta:
-                duration += delta
+        duration = ActivityStatisticCalculator._summarize(act, startWpt, endWpt, timer=True)["TimerTime"]
         if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
             raise ValueError("Zero-duration activity")
         return duration
 
-    def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
-        flatWaypoints = act.GetFlatWaypoints()
-
-        # Python can handle 600+ digit numbers, think it can handle this
-        maxHR = 0
-        cumulHR = 0
-        samples = 0
-
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            if wpt.HR:
-                if wpt.HR > maxHR:
-                    maxHR = wpt.HR
-                cumulHR += wpt.HR
-                samples += 1
-
-        if not samples:
-            return None, None
-
-        cumulHR = cumulHR / samples
-        return cumulHR, maxHR
-
+    def CalculateMovingTime(act, startWpt=None, endWpt=None):
+        """ Like CalculateTimerTime, less any time spent stationary - going by the distance between waypoints, their Speed if they don't have locations, or assuming it was moving if neither """
+        return ActivityStatisticCalculator._summarize(act, startWpt, endWpt, moving=True)["MovingTime"]
 
+    def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
+        summary = ActivityStatisticCalculator._summarize(act, startWpt, endWpt, hr=True)
+        return summary["AverageHR"], summary["MaxHR"]
+
+    def CalculateStatistics(act, startWpt=None, endWpt=None):
+        """ Distance, timer time, moving time and HR all at once, as an ActivityStatistics """
+        from .interchange import ActivityStatistics
+        summary = ActivityStatisticCalculator._summarize(act, startWpt, endWpt, distance=True, timer=True, moving=True, hr=True)
+        return ActivityStatistics(distance=summary["Distance"], timer_time=summary["TimerTime"].total_seconds(), moving_time=summary["MovingTime"].total_seconds(), avg_hr=summary["AverageHR"], max_hr=summary["MaxHR"])
+
+    def _waypointRange(act, startWpt, endWpt):
+        # Only need to go looking through the waypoints if we've been given some to find
+        count = act.CountTotalWaypoints()
+        if not count:
+            raise IndexError("Activity has no waypoints")
+        start, end = 0, count - 1
+        if startWpt or endWpt:
+            flatWaypoints = act.GetFlatWaypoints()
+            if startWpt:
+                start = flatWaypoints.index(startWpt)
+            if endWpt:
+                end = flatWaypoints.index(endWpt)
+        return start, end
+
+    def _summarize(act, startWpt, endWpt, distance=False, timer=False, moving=False, hr=False):
+        start, end = ActivityStatisticCalculator._waypointRange(act, startWpt, endWpt)
+        fields = []
+        if distance or timer or moving:
+            fields += ["Timestamp", "Type"]
+        if distance or moving:
+            fields += ["Latitude", "Longitude", "Altitude"]
+        if moving:
+            fields += ["Speed"]
+        if hr:
+            fields += ["HR"]
+        columns = dict((field, act.GetFlatWaypointColumn(field)[start:end + 1]) for field in fields)
+
+        if numpy is not None:
+            columns = dict((field, numpy.frombuffer(column, dtype=numpy.float64)) for field, column in columns.items())
+            summary = ActivityStatisticCalculator._summarizeNumPy(columns)
+        else:
+            summary = ActivityStatisticCalculator._summarizePython(columns)
+
+        if "TimerTime" in summary:
+            summary["TimerTime"] = timedelta(microseconds=summary["TimerTime"])
+            summary["MovingTime"] = timedelta(microseconds=summary["MovingTime"])
+        if "MaxHR" in summary and summary["MaxHR"] is not None and summary["MaxHR"].is_integer():
+            summary["MaxHR"] = int(summary["MaxHR"])
+        return summary
+
+    def _segmentDistance(lat, lon, dLat, dLon, dAlt):
+        # A flat-earth approximation, which is plenty at the distances between waypoints
+        latRads = lat * math.pi / 180
+        meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
+        meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
+        dx = dLon * meters_lon_degree
+        dy = dLat * meters_lat_degree
+        return math.sqrt(dx ** 2 + dy ** 2 + dAlt ** 2)
+
+    def _summarizePython(columns):
+        summary = {}
+        if "Timestamp" in columns:
+            timestamps, types = columns["Timestamp"], columns["Type"]
+            lats, lons, alts = columns.get("Latitude"), columns.get("Longitude"), columns.get("Altitude")
+            speeds = columns.get("Speed")
+            implicitPauseTime = ActivityStatisticCalculator.ImplicitPauseTime // timedelta(microseconds=1)
+            distance = timerTime = movingTime = 0
+            altHold = None  # seperate from lastLoc, since we want to hold the altitude as long as required
+            lastLoc = None
+            for x in range(len(timestamps)):
+                # Microseconds since the previous waypoint
+                delta = round((timestamps[x] - timestamps[x - 1]) * 1000000) if x and not math.isnan(timestamps[x] - timestamps[x - 1]) else None
+                paused = types[x] == WaypointType.Pause
+                implicitlyPaused = delta is not None and delta > implicitPauseTime
+                segment = None
+                if lats is not None:
+                    if paused or implicitlyPaused:
+                        lastLoc = None  # don't count distance while paused
+                    elif not math.isnan(lats[x]) and not math.isnan(lons[x]):
+                        # (waypoints without locations are skipped over)
+                        if lastLoc is not None:
+                            altHold = alts[lastLoc] if not math.isnan(alts[lastLoc]) else altHold
+                            dAlt = alts[x] - altHold if not math.isnan(alts[x]) and altHold is not None else 0
+                            segment = ActivityStatisticCalculator._segmentDistance(lats[x], lons[x], lats[x] - lats[lastLoc], lons[x] - lons[lastLoc], dAlt)
+                            distance += segment
+                        lastLoc = x
+                # Timer time stops at explicit pauses until the next waypoint, and skips over implicit pauses
+                if x and types[x - 1] != WaypointType.Pause and delta and (paused or not implicitlyPaused):
+                    timerTime += delta
+                    if speeds is not None:
+                        if segment is not None:
+                            isMoving = segment / (delta / 1000000) >= ActivityStatisticCalculator.MovingSpeedThreshold
+                        elif not math.isnan(speeds[x]):
+                            isMoving = speeds[x] >= ActivityStatisticCalculator.MovingSpeedThreshold
+                        else:
+                            isMoving = True
+                        if isMoving:
+                            movingTime += delta
+            summary.update({"Distance": distance, "TimerTime": timerTime, "MovingTime": movingTime})
+
+        if "HR" in columns:
+            maxHR = 0
+            cumulHR = 0
+            samples = 0
+            for hr in columns["HR"]:
+                if hr and not math.isnan(hr):
+                    if hr > maxHR:
+                        maxHR = hr
+                    cumulHR += hr
+                    samples += 1
+            summary.update({"AverageHR": cumulHR / samples if samples else None, "MaxHR": maxHR if samples else None})
+        return summary
+
+    def _summarizeNumPy(columns):
+        # The same as _summarizePython, just array-at-a-time
+        summary = {}
+        if "Timestamp" in columns:
+            timestamps, types = columns["Timestamp"], columns["Type"]
+            count = len(timestamps)
+            deltas = numpy.full(count, numpy.nan)
+            deltas[1:] = numpy.rint(numpy.diff(timestamps) * 1000000)
+            paused = types == WaypointType.Pause
+            with numpy.errstate(invalid="ignore"):
+                implicitlyPaused = deltas > ActivityStatisticCalculator.ImplicitPauseTime // timedelta(microseconds=1)
+            segments = numpy.full(count, numpy.nan)
+
+            if "Latitude" in columns:
+                lats, lons, alts = columns["Latitude"], columns["Longitude"], columns["Altitude"]
+                breaks = paused | implicitlyPaused
+                # Distance is between each located waypoint and the one before it - unless there was a pause in between
+                located = numpy.flatnonzero(~(numpy.isnan(lats) | numpy.isnan(lons) | breaks))
+                pauseCount = numpy.cumsum(breaks)
+                previous, current = located[:-1], located[1:]
+                unbroken = pauseCount[previous] == pauseCount[current]
+                previous, current = previous[unbroken], current[unbroken]
+                # The altitude is held from the last waypoint that had one
+                previousAlts = alts[previous]
+                altHold = previousAlts[numpy.maximum.accumulate(numpy.where(numpy.isnan(previousAlts), 0, numpy.arange(len(previousAlts))))] if len(previousAlts) else previousAlts
+                dAlt = alts[current] - altHold
+                dAlt[numpy.isnan(dAlt)] = 0
+                latRads = lats[current] * numpy.pi / 180
+                meters_lat_degree = 1000 * 111.13292 + 1.175 * numpy.cos(4 * latRads) - 559.82 * numpy.cos(2 * latRads)
+                meters_lon_degree = 1000 * 111.41284 * numpy.cos(latRads) - 93.5 * numpy.cos(3 * latRads)
+                dx = (lons[current] - lons[previous]) * meters_lon_degree
+                dy = (lats[current] - lats[previous]) * meters_lat_degree
+                segments[current] = numpy.sqrt(dx ** 2 + dy ** 2 + dAlt ** 2)
+                summary["Distance"] = float(segments[current].sum())
+
+            counted = numpy.zeros(count, dtype=bool)
+            counted[1:] = types[:-1] != WaypointType.Pause
+            counted &= (deltas != 0) & ~numpy.isnan(deltas) & (paused | ~implicitlyPaused)
+            summary["TimerTime"] = int(deltas[counted].sum())
+
+            if "Speed" in columns:
+                with numpy.errstate(invalid="ignore", divide="ignore"):
+                    speeds = numpy.where(numpy.isnan(segments), columns["Speed"], segments / (deltas / 1000000))
+                    isMoving = numpy.isnan(speeds) | (speeds >= ActivityStatisticCalculator.MovingSpeedThreshold)
+                summary["MovingTime"] = int(deltas[counted & isMoving].sum())
+            else:
+                summary["MovingTime"] = 0
+
+        if "HR" in columns:
+            hrs = columns["HR"]
+            hrs = hrs[~numpy.isnan(hrs) & (hrs != 0)]
+            summary.update({"AverageHR": float(hrs.sum()) / len(hrs) if len(hrs) else None, "MaxHR": max(0, float(hrs.max())) if len(hrs) else None})
+        return summary
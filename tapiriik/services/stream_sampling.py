@@ -1,7 +1,10 @@
+import heapq
+
 class StreamSampler:
     def SampleWithCallback(callback, streams):
         """
             *streams should be a dict in format {"stream1":[(ts1,val1), (ts2, val2)...]...} where ts is a numerical offset from the activity start.
+            Each stream can be any iterable (generators included) - they're only read through once, in step with each other.
             Expect callback(time_offset, stream1=value1, stream2=value2) in chronological order. Stream values may be None
             All samples are represented - none are dropped
         """
@@ -10,36 +13,26 @@ class StreamSampler:
         # There is no global sampling rate - waypoints are created for every new datapoint in any stream (simultaneous datapoints are included in the same waypoint)
         # Resampling is based on the last known value of the stream - no interpolation or nearest-neighbour.
 
-        streamData = streams
-        streams = list(streams.keys())
-        print("Handling streams %s" % streams)
-
-        stream_indices = dict([(stream, -1) for stream in streams]) # -1 meaning the stream has yet to start
-        stream_lengths = dict([(stream, len(streamData[stream])) for stream in streams])
+        # A heap of the next sample from each stream, so finding the earliest doesn't mean checking them all - the stream's position breaks ties, so it's the first listed that sets the time offset.
+        pending = []
+        for position, (stream, samples) in enumerate(streams.items()):
+            samples = iter(samples)
+            for offset, value in samples:
+                pending.append((offset, position, stream, value, samples))
+                break
+        heapq.heapify(pending)
 
-        currentTimeOffset = 0
+        current_values = {} # Streams only show up once they've started
 
-        while True:
-            advance_stream = None
-            advance_offset = None
-            for stream in streams:
-                if stream_indices[stream] + 1 == stream_lengths[stream]:
-                    continue # We're at the end - can't advance
-                if advance_offset is None or streamData[stream][stream_indices[stream] + 1][0] - currentTimeOffset < advance_offset:
-                    advance_offset = streamData[stream][stream_indices[stream] + 1][0] - currentTimeOffset
-                    advance_stream = stream
-            if not advance_stream:
-                break # We've hit the end of every stream, stop
-            # Update the current time offset based on the key advancing stream (others may still be behind)
-            currentTimeOffset = streamData[advance_stream][stream_indices[advance_stream] + 1][0]
-            # Advance streams with the current timestamp, including advance_stream
-            for stream in streams:
-                if stream_indices[stream] + 1 == stream_lengths[stream]:
-                    continue # We're at the end - can't advance
-                if streamData[stream][stream_indices[stream] + 1][0] == currentTimeOffset: # Don't need to consider <, as then that stream would be advance_stream
-                    stream_indices[stream] += 1
-            callbackDataArgs = {}
-            for stream in streams:
-                if stream_indices[stream] >= 0:
-                    callbackDataArgs[stream] = streamData[stream][stream_indices[stream]][1]
-            callback(currentTimeOffset, **callbackDataArgs)
+        while pending:
+            # Advance every stream with a sample at this time offset - by one sample each, since a stream might have several at the same offset
+            currentTimeOffset = pending[0][0]
+            advanced = []
+            while pending and pending[0][0] == currentTimeOffset:
+                advanced.append(heapq.heappop(pending))
+            for offset, position, stream, value, samples in advanced:
+                current_values[stream] = value
+                for offset, value in samples:
+                    heapq.heappush(pending, (offset, position, stream, value, samples))
+                    break
+            callback(currentTimeOffset, **current_values)
@@ -0,0 +1,155 @@
+from tapiriik.services.interchange import ActivityType
+from datetime import timedelta
+
+class DuplicateActivityIndex:
+    """ Holds the activities accumulated during a sync, bucketed so that finding probable duplicates of a newly-listed activity doesn't mean scanning everything around it.
+        The candidates found (and the one picked) are the same as the old linear scan over the start-time-sorted list.
+    """
+
+    ActivityStartLeeway = timedelta(minutes=3)
+    ActivityStartTZOffsetLeeway = timedelta(minutes=1)
+    TimezoneErrorPeriod = timedelta(hours=38)
+
+    def __init__(self, activities=None):
+        self._entries = {} # id(activity) -> _IndexedActivity
+        self._byUID = {}
+        self._byNaiveMinute = {}
+        self._byUTCMinute = {}
+        self._byDateMinute = {}
+        self._sequence = 0
+        self._sortedActivities = []
+        # The list we're handed is already in the expected order, and later insertions go before equivalent start times.
+        for act in reversed(activities or []):
+            self.Add(act)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Activities(self):
+        # Most recent first - for equal start times, the most recently added first (as bisect.insort_left used to do)
+        if self._sortedActivities is None:
+            self._sortedActivities = [x.Activity for x in sorted(self._entries.values(), key=lambda x: (x.NaiveStartTime, x.Sequence), reverse=True)]
+        return self._sortedActivities
+
+    def Add(self, activity):
+        self._sequence += 1
+        entry = _IndexedActivity(activity, self._sequence)
+        self._entries[id(activity)] = entry
+        self._insert(entry)
+        self._sortedActivities = None
+
+    def Update(self, activity):
+        """ Call after changing an indexed activity's StartTime or UID """
+        entry = self._entries[id(activity)]
+        if entry.StartTime is activity.StartTime and entry.UID == activity.UID:
+            return
+        self._remove(entry)
+        entry = _IndexedActivity(activity, entry.Sequence)
+        self._entries[id(activity)] = entry
+        self._insert(entry)
+        self._sortedActivities = None
+
+    def FindDuplicate(self, activity):
+        target = _IndexedActivity(activity, None)
+        candidates = {}
+        for entry in self._byUID.get(target.UID, []):
+            candidates[id(entry)] = entry
+        if target.NaiveStartTime is not None:
+            for bucketIndex, minute in ((self._byNaiveMinute, target.NaiveMinute), (self._byUTCMinute, target.UTCMinute)):
+                if minute is None:
+                    continue
+                # Anything within ActivityStartLeeway of this activity will be in one of these buckets
+                for offset in range(-3, 4):
+                    for entry in bucketIndex.get(minute + offset, []):
+                        candidates[id(entry)] = entry
+            # Same mm:ss (give or take ActivityStartTZOffsetLeeway) or 30 minutes off of it, on the same day - see _isProbableDuplicate
+            for minuteOfHour in list(range(target.MinuteOfHour - 1, target.MinuteOfHour + 2)) + \
+                                list(range(target.MinuteOfHour - 31, target.MinuteOfHour - 28)) + \
+                                list(range(target.MinuteOfHour + 29, target.MinuteOfHour + 32)):
+                for entry in self._byDateMinute.get((target.Date, minuteOfHour), []):
+                    candidates[id(entry)] = entry
+
+        matches = [x for x in candidates.values() if self._isProbableDuplicate(target, x)]
+        if not matches:
+            return None
+        # The first of these in the sorted list is the one that would have been picked.
+        return max(matches, key=lambda x: (x.NaiveStartTime, x.Sequence)).Activity
+
+    def _isProbableDuplicate(self, act, x):
+        # Only activities starting within TimezoneErrorPeriod were ever considered.
+        if act.NaiveStartTime is None or x.NaiveStartTime is None or abs(act.NaiveStartTime - x.NaiveStartTime) > self.TimezoneErrorPeriod:
+            return False
+        # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
+        actType = act.Activity.Type
+        xType = x.Activity.Type
+        if not (xType == ActivityType.Other or actType == ActivityType.Other or xType == actType or ActivityType.AreVariants([actType, xType])):
+            return False
+        # Identical
+        if x.UID == act.UID:
+            return True
+        if act.Aware == x.Aware:
+            # Check to see if the activities are reasonably close together to be considered duplicate
+            # (datetime subtraction ignores the offsets outright when both share a tzinfo)
+            if act.Aware and act.StartTime.tzinfo is not x.StartTime.tzinfo:
+                if abs(act.UTCStartTime - x.UTCStartTime) < self.ActivityStartLeeway:
+                    return True
+            elif abs(act.NaiveStartTime - x.NaiveStartTime) < self.ActivityStartLeeway:
+                return True
+        else:
+            # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
+            if abs(act.NaiveStartTime - x.NaiveStartTime) < self.ActivityStartLeeway:
+                return True
+        # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
+        # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
+        #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+        # There's a very low chance that two activities in this period would intersect and be merged together.
+        # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+        if abs(act.NaiveStartTime - x.NaiveStartTime) < self.TimezoneErrorPeriod:
+            hourlessDifference = abs(act.HourlessStartTime - x.HourlessStartTime)
+            if hourlessDifference < self.ActivityStartTZOffsetLeeway:
+                return True
+            # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
+            if hourlessDifference > timedelta(minutes=30) - (self.ActivityStartTZOffsetLeeway / 2) and hourlessDifference < timedelta(minutes=30) + (self.ActivityStartTZOffsetLeeway / 2):
+                return True
+        return False
+
+    def _buckets(self, entry):
+        yield self._byUID, entry.UID
+        if entry.NaiveStartTime is not None:
+            yield self._byNaiveMinute, entry.NaiveMinute
+            if entry.UTCMinute is not None:
+                yield self._byUTCMinute, entry.UTCMinute
+            yield self._byDateMinute, (entry.Date, entry.MinuteOfHour)
+
+    def _insert(self, entry):
+        for bucketIndex, key in self._buckets(entry):
+            bucketIndex.setdefault(key, []).append(entry)
+
+    def _remove(self, entry):
+        for bucketIndex, key in self._buckets(entry):
+            bucketIndex[key].remove(entry)
+            if not bucketIndex[key]:
+                del bucketIndex[key]
+
+class _IndexedActivity:
+    # The start time, precomputed in the various forms the duplicate checks need.
+    def __init__(self, activity, sequence):
+        self.Activity = activity
+        self.Sequence = sequence
+        self.UID = activity.UID
+        self.StartTime = activity.StartTime
+        self.NaiveStartTime = self.UTCStartTime = self.NaiveMinute = self.UTCMinute = None
+        if self.StartTime is None:
+            return
+        self.Aware = self.StartTime.tzinfo is not None
+        self.NaiveStartTime = self.StartTime.replace(tzinfo=None)
+        self.NaiveMinute = _minuteKey(self.NaiveStartTime)
+        if self.Aware:
+            self.UTCStartTime = self.NaiveStartTime - self.StartTime.utcoffset()
+            self.UTCMinute = _minuteKey(self.UTCStartTime)
+        self.Date = self.NaiveStartTime.date()
+        self.MinuteOfHour = self.NaiveStartTime.minute
+        self.HourlessStartTime = self.NaiveStartTime.replace(hour=0)
+
+def _minuteKey(dt):
+    return dt.toordinal() * 1440 + dt.hour * 60 + dt.minute
@@ -0,0 +1,78 @@
+from tapiriik.database import db
+from tapiriik.messagequeue import mq
+from tapiriik.settings import SYNC_SCHEDULER_ADMISSION_PROBE, SYNC_SCHEDULER_ADMISSION_ROUNDS, SYNC_LANES, RABBITMQ_QUEUE_LIST_URL
+from tapiriik.sync import Sync
+from datetime import datetime, timedelta
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+class SyncQueueProbe:
+    """ Tells sync_scheduler how many more users the sync workers can take on soon, so the rest can stay due in the users collection rather than languishing in the queue.
+        Subclasses just need to report how many messages are waiting to be picked up - worker availability comes from the sync_workers heartbeats either way.
+    """
+    # Workers that haven't checked in for this long aren't counted
+    WorkerTimeout = timedelta(minutes=5)
+
+    def FromSettings():
+        """ The probe configured by SYNC_SCHEDULER_ADMISSION_PROBE, or None when admission control is off """
+        if not SYNC_SCHEDULER_ADMISSION_PROBE:
+            return None
+        return {
+            "kombu": KombuQueueProbe,
+            "management": ManagementAPIQueueProbe
+        }[SYNC_SCHEDULER_ADMISSION_PROBE]()
+
+    def QueueDepth(self):
+        raise NotImplementedError
+
+    def AdmissionLimit(self):
+        """ How many users can be queued right now - enough to fill the free sync slots, plus SYNC_SCHEDULER_ADMISSION_ROUNDS rounds' worth of waiting work, less what's already waiting """
+        capacity = 0
+        busy = 0
+        for worker in db.sync_workers.find({"Heartbeat": {"$gt": datetime.utcnow() - self.WorkerTimeout}}, {"Concurrency": 1, "Tasks": 1}):
+            capacity += worker.get("Concurrency", 1)
+            busy += len(worker.get("Tasks", {}))
+        try:
+            depth = self.QueueDepth()
+        except Exception:
+            # Better to carry on as if this were off than stop scheduling altogether
+            logger.exception("Could not determine queue depth")
+            return None
+        return max(0, capacity - busy + capacity * SYNC_SCHEDULER_ADMISSION_ROUNDS - depth)
+
+    def _queueNames(self):
+        # One per lane, plus one per host (see Sync.InitializeWorkerBindings)
+        return [Sync.LaneQueueName(lane) for lane in SYNC_LANES] + ["tapiriik-users-%s" % host for host in db.sync_workers.distinct("Host")]
+
+
+class KombuQueueProbe(SyncQueueProbe):
+    # Passive declares report the ready message count without touching the queue
+    def __init__(self):
+        self._channel = None
+
+    def QueueDepth(self):
+        depth = 0
+        for queueName in self._queueNames():
+            if self._channel is None:
+                self._channel = mq.channel()
+            try:
+                depth += self._channel.queue_declare(queue=queueName, passive=True).message_count
+            except Exception:
+                # The broker closes the channel if the queue doesn't exist (a host that's gone away, say)
+                logger.warning("Could not inspect queue %s" % queueName)
+                try:
+                    self._channel.close()
+                except Exception:
+                    pass
+                self._channel = None
+        return depth
+
+
+class ManagementAPIQueueProbe(SyncQueueProbe):
+    # One request covers every queue - though the numbers it reports can be a few seconds old
+    def QueueDepth(self):
+        queues = requests.get(RABBITMQ_QUEUE_LIST_URL, params={"columns": "name,messages_ready"}).json()
+        queueNames = set(self._queueNames())
+        return sum(x.get("messages_ready", 0) for x in queues if x["name"] in queueNames)
@@ -0,0 +1,42 @@
+from tapiriik.settings import SYNC_ADAPTIVE_INTERVAL
+from datetime import datetime, timedelta
+
+class SyncIntervalPolicy:
+    """ Decides how long until a user's next automatic sync, based on what their recent syncs turned up.
+        Users who keep turning up new activities are synced more often than the standard interval, and accounts that have gone quiet progressively less often.
+        This only covers automatic rescheduling - immediate syncs (from the dashboard, or from a service's trigger) don't go through here.
+    """
+
+    StandardInterval = timedelta(hours=1)
+    MinimumInterval = timedelta(minutes=20)
+    MaximumInterval = timedelta(hours=12)
+    # Once nothing new has turned up for this long, the interval starts stretching (in proportion)
+    IdlePeriod = timedelta(days=7)
+    # How much each sync counts towards the running averages below
+    HistoryWeight = 0.2
+
+    def Interval(user):
+        """ The time until this user's next automatic sync, per the history recorded by HistoryUpdate """
+        if not SYNC_ADAPTIVE_INTERVAL:
+            return SyncIntervalPolicy.StandardInterval
+        now = datetime.utcnow()
+        lastActivity = user.get("LastActivitySynchronization", None)
+        idleFactor = max(1, (now - lastActivity) / SyncIntervalPolicy.IdlePeriod) if lastActivity else 1
+        # Averaging one new activity per sync halves the interval, and so on
+        activityFactor = 1 / (1 + user.get("SyncActivityRate", 0))
+        # When most syncs are triggered, the automatic ones are just a backstop for whatever the triggers missed
+        triggerFactor = 1 + user.get("SyncTriggerRate", 0)
+        interval = SyncIntervalPolicy.StandardInterval * (idleFactor * activityFactor * triggerFactor)
+        return max(SyncIntervalPolicy.MinimumInterval, min(SyncIntervalPolicy.MaximumInterval, interval))
+
+    def HistoryUpdate(user, result):
+        """ The fields to $set on the user to record the sync that produced this SynchronizationTaskResult """
+        weight = SyncIntervalPolicy.HistoryWeight
+        update = {
+            "SyncActivityRate": (1 - weight) * user.get("SyncActivityRate", 0) + weight * result.ActivitiesSynchronized,
+            "SyncTriggerRate": (1 - weight) * user.get("SyncTriggerRate", 0) + weight * (1 if result.Triggered else 0)
+        }
+        # (for users from before this was recorded, the clock starts now)
+        if result.ActivitiesSynchronized or not user.get("LastActivitySynchronization", None):
+            update["LastActivitySynchronization"] = datetime.utcnow()
+        return update
@@ -0,0 +1,118 @@
+from tapiriik.database import db, redis
+from tapiriik.settings import SYNC_SCHEDULE_REDIS, SYNC_SCHEDULE_SLOT_SIZE, SYNC_SCHEDULER_TARGET_RATE
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import calendar
+import random
+
+class RedisSyncSchedule:
+    """ Optionally mirrors each user's NextSynchronization into a Redis sorted set (scored by timestamp), so sync_scheduler can pop whoever's due without polling the users collection.
+        The users collection remains the source of truth - anything popped is checked against it, and Reconcile() brings the set back in line with it.
+    """
+    Key = "sync-schedule"
+    _popDueScript = None
+
+    def Enabled():
+        return SYNC_SCHEDULE_REDIS and redis is not None
+
+    def _score(next_sync):
+        return calendar.timegm(next_sync.utctimetuple()) + next_sync.microsecond / 1000000
+
+    def Schedule(user_ids, next_sync):
+        """ Call alongside any update to these users' NextSynchronization - None removes them """
+        if not RedisSyncSchedule.Enabled() or not user_ids:
+            return
+        if next_sync is None:
+            redis.zrem(RedisSyncSchedule.Key, *[str(x) for x in user_ids])
+        else:
+            score = RedisSyncSchedule._score(next_sync)
+            redis.zadd(RedisSyncSchedule.Key, dict((str(x), score) for x in user_ids))
+
+    def ScheduleMatching(query, next_sync):
+        """ For the bulk updates - mirrors whichever users the query matched """
+        if not RedisSyncSchedule.Enabled():
+            return
+        RedisSyncSchedule.Schedule([x["_id"] for x in db.users.find(query, {"_id": 1})], next_sync)
+
+    def PopDue(due_by, limit):
+        """ Atomically removes and returns (as ObjectIds) up to <limit> users scheduled on or before due_by, most overdue first """
+        if RedisSyncSchedule._popDueScript is None:
+            RedisSyncSchedule._popDueScript = redis.register_script("""
+                local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+                if #due > 0 then
+                    redis.call("ZREM", KEYS[1], unpack(due))
+                end
+                return due
+            """)
+        due = RedisSyncSchedule._popDueScript(keys=[RedisSyncSchedule.Key], args=[RedisSyncSchedule._score(due_by), limit])
+        return [ObjectId(x.decode("utf-8") if isinstance(x, bytes) else x) for x in due]
+
+    def Reconcile(batch_size=1000):
+        """ Re-adds every user with a NextSynchronization, at that time. Returns how many there were """
+        if not RedisSyncSchedule.Enabled():
+            return 0
+        count = 0
+        pipeline = redis.pipeline(transaction=False)
+        for user in db.users.find({"NextSynchronization": {"$ne": None}}, {"NextSynchronization": 1}).batch_size(batch_size):
+            pipeline.zadd(RedisSyncSchedule.Key, {str(user["_id"]): RedisSyncSchedule._score(user["NextSynchronization"])})
+            count += 1
+            if count % batch_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+        return count
+
+
+class SyncSlotHistogram:
+    """ Counts how many users are due in each SYNC_SCHEDULE_SLOT_SIZE-second slot, so new due times can go wherever is least busy rather than wherever random jitter lands them.
+        Shared between workers via Redis - without it, due times are just spread uniformly.
+    """
+    KeyPrefix = "sync-slot:"
+    # How long bulk reschedules are spread over, when there's no SYNC_SCHEDULER_TARGET_RATE to go by
+    BulkSpread = timedelta(minutes=5)
+    _placeScript = None
+
+    def Spread(start, count):
+        """ Due times for <count> users rescheduled all at once, spread out from <start> over as long as the scheduler would take to dispatch them anyways """
+        window = timedelta(seconds=count / SYNC_SCHEDULER_TARGET_RATE) if SYNC_SCHEDULER_TARGET_RATE else SyncSlotHistogram.BulkSpread
+        return sorted(SyncSlotHistogram.Place(start + window / 2, window / 2, count))
+
+    def Place(target, spread, count=1):
+        """ Returns <count> due times within <spread> of <target>, each in the least occupied slot at the time (the nearest such, for ties) """
+        if redis is None or spread <= timedelta(0):
+            return [target + timedelta(seconds=random.uniform(-spread.total_seconds(), spread.total_seconds())) for x in range(count)]
+        slotSize = SYNC_SCHEDULE_SLOT_SIZE
+        targetTimestamp = calendar.timegm(target.utctimetuple())
+        slotSpread = int(spread.total_seconds() // slotSize)
+        targetSlot = targetTimestamp // slotSize
+        # Nearest first, so that's where ties go
+        slots = sorted(range(targetSlot - slotSpread, targetSlot + slotSpread + 1), key=lambda slot: abs(slot - targetSlot))
+        if SyncSlotHistogram._placeScript is None:
+            SyncSlotHistogram._placeScript = redis.register_script("""
+                local counts = {}
+                local original = {}
+                for i, key in ipairs(KEYS) do
+                    counts[i] = tonumber(redis.call("GET", key) or "0")
+                    original[i] = counts[i]
+                end
+                local placed = {}
+                for n = 1, tonumber(ARGV[1]) do
+                    local best = 1
+                    for i = 2, #KEYS do
+                        if counts[i] < counts[best] then
+                            best = i
+                        end
+                    end
+                    counts[best] = counts[best] + 1
+                    placed[n] = best - 1
+                end
+                for i, key in ipairs(KEYS) do
+                    if counts[i] ~= original[i] then
+                        redis.call("SET", key, counts[i], "EX", ARGV[2])
+                    end
+                end
+                return placed
+            """)
+        # The counts are only useful until the slot has passed
+        expiry = max(slotSize, targetTimestamp + spread.total_seconds() - calendar.timegm(datetime.utcnow().utctimetuple())) + slotSize
+        placed = SyncSlotHistogram._placeScript(keys=[SyncSlotHistogram.KeyPrefix + str(slot) for slot in slots], args=[count, int(expiry)])
+        return [datetime.utcfromtimestamp(slots[int(x)] * slotSize + random.uniform(0, slotSize)) for x in placed]
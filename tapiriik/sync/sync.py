@@ -1,9 +1,16 @@
 from tapiriik.database import db, cachedb, redis
 from tapiriik.messagequeue import mq
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
+from tapiriik.settings import USER_SYNC_LOG_LEVEL, DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_LISTING_CONCURRENCY, SYNC_PIPELINE_DEPTH, SYNC_PIPELINE_WAYPOINT_LIMIT, SYNC_UPLOAD_CONCURRENCY, SYNC_WRITE_BUFFER_SIZE, SYNC_WRITE_BUFFER_INTERVAL, SYNC_PROGRESS_REPORT_INTERVAL, SYNC_PROGRESS_REPORT_DELTA, SYNCHRONIZED_ACTIVITIES_QUERY_BATCH_SIZE, SYNC_LANES, SYNC_LANE_SLOT_SHARE
 from .activity_record import ActivityRecord, ActivityServicePrescence
+from .activity_index import DuplicateActivityIndex
+from .write_buffer import SyncWriteBuffer
+from .user_logs import UserSyncLog, UserSyncLogHandler, UserSyncLogSink
+from .schedule import RedisSyncSchedule, SyncSlotHistogram
+from .interval import SyncIntervalPolicy
+from bson.objectid import ObjectId
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
 import io
@@ -11,14 +18,15 @@ import socket
 import traceback
 import pprint
 import copy
-import random
 import logging
-import logging.handlers
 import pymongo
 import pytz
 import kombu
 import json
-import bisect
+import collections
+import threading
+import queue
+import time
 
 # Set this up separate from the logger used in this scope, so services logging messages are caught and logged into user's files.
 _global_logger = logging.getLogger("tapiriik")
@@ -35,6 +43,23 @@ if hasattr(sys.stdout, "buffer"):
 
 logger = logging.getLogger("tapiriik.sync.worker")
 
+# Which SynchronizationTask the current thread is working for, if any - see _SyncTaskLogFilter
+_syncTaskContext = threading.local()
+
+class _SyncTaskLogFilter(logging.Filter):
+    # With several tasks running in one process, the per-user log handlers all hang off the same global logger.
+    # So each only accepts records logged from threads working on its own task.
+    def __init__(self, task):
+        super().__init__()
+        self._task = task
+
+    def filter(self, record):
+        return getattr(_syncTaskContext, "task", None) is self._task
+
+def _ignoreDuplicateKeyError(code):
+    # Upserts racing each other on a unique index - whichever won, the document's there
+    return code == 11000
+
 def _formatExc():
     try:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -85,16 +110,20 @@ def _unpackUserException(raw):
 
 class Sync:
 
-    SyncInterval = timedelta(hours=1)
+    SyncInterval = SyncIntervalPolicy.StandardInterval
     SyncIntervalJitter = timedelta(minutes=5)
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
+    IdleHeartbeatInterval = timedelta(minutes=1)  # Well inside SyncQueueProbe.WorkerTimeout, so idle workers still count as free capacity
+    DispatchWait = 0.25  # Seconds the worker waits on the broker before checking on its running syncs - a local wait, not a round trip
 
     def ScheduleImmediateSync(user, exhaustive=None):
+        nextSync = datetime.utcnow()
         if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "NextSyncLane": "interactive"}})
         else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "NextSyncLane": "interactive", "NextSyncIsExhaustive": exhaustive}})
+        RedisSyncSchedule.Schedule([user["_id"]], nextSync)
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
@@ -110,24 +139,132 @@ class Sync:
         # Bind to worker-specific and general routing keys
         Sync._global_queue.bind_to(exchange="tapiriik-users", routing_key="")
         Sync._host_queue.bind_to(exchange="tapiriik-users", routing_key=socket.gethostname())
+        # One queue per lane (see SyncLane) - the periodic lane is the original global queue
+        Sync._lane_queues = {}
+        for lane in SYNC_LANES:
+            if lane == "periodic":
+                Sync._lane_queues[lane] = Sync._global_queue
+                continue
+            Sync._lane_queues[lane] = kombu.Queue(Sync.LaneQueueName(lane))(Sync._channel)
+            Sync._lane_queues[lane].declare()
+            Sync._lane_queues[lane].bind_to(exchange="tapiriik-users", routing_key=Sync.LaneRoutingKey(lane))
+        # For loading a user's activity records, and the range queries on the activities dashboard
+        db.user_activity_records.ensure_index([("UserID", pymongo.ASCENDING), ("StartTime", pymongo.DESCENDING)])
+        db.synchronized_activities.ensure_index([("ConnectionID", pymongo.ASCENDING), ("UID", pymongo.ASCENDING)], unique=True)
+        UserSyncLogSink.EnsureIndexes()
+
+    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None, concurrency=1):
+        if concurrency > 1:
+            return Sync._performConcurrentGlobalSync(heartbeat_callback, version, max_users, concurrency)
+
+        processedUsers = 0
 
-    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None):
         def _callback(body, message):
+            nonlocal processedUsers
             Sync._consumeSyncTask(body, message, heartbeat_callback, version)
+            message.ack()
+            processedUsers += 1
 
-        Sync._consumer = kombu.Consumer(
-            channel=Sync._channel,
-            queues=[Sync._host_queue, Sync._global_queue],
-            callbacks=[_callback],
-            auto_declare=False
-        )
+        Sync._consumeLanes(_callback, 1)
 
-        Sync._consumer.qos(prefetch_count=1, apply_global=False)
+        idleHeartbeat = Sync._idleHeartbeat(heartbeat_callback)
+        while not max_users or processedUsers < max_users:
+            try:
+                mq.drain_events(timeout=Sync.DispatchWait)
+            except socket.timeout:
+                idleHeartbeat()
+
+    def _performConcurrentGlobalSync(heartbeat_callback, version, max_users, concurrency):
+        # The sync tasks run on a thread pool, but the channel isn't thread-safe.
+        # So messages are only ever received and acknowledged from this thread - the tasks hand them back here when they're done.
+        completedMessages = queue.Queue()
+        receivedUsers = 0
+        finishedUsers = 0
+
+        def _runSyncTask(body, message):
+            try:
+                Sync._consumeSyncTask(body, message, heartbeat_callback, version)
+            except:
+                # When running one at a time, this would take the worker down (and the message would be redelivered).
+                # Here, that'd take everyone else's sync along with it - and the user has been rescheduled by this point anyways.
+                logger.exception("Sync task for %s failed" % body["user_id"])
+            finally:
+                completedMessages.put(message)
+
+        def _callback(body, message):
+            nonlocal receivedUsers
+            if max_users and receivedUsers >= max_users:
+                # Delivered before we stopped consuming - someone else can have it.
+                message.requeue()
+                return
+            receivedUsers += 1
+            if max_users and receivedUsers >= max_users:
+                for consumer in Sync._consumers:
+                    consumer.cancel()
+            executor.submit(_runSyncTask, body, message)
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
 
-        Sync._consumer.consume()
+        Sync._consumeLanes(_callback, concurrency)
 
-        for _ in kombu.eventloop(mq, limit=max_users):
-            pass
+        idleHeartbeat = Sync._idleHeartbeat(heartbeat_callback)
+        try:
+            while not max_users or finishedUsers < max_users:
+                # New deliveries wake this straight away - the timeout is just for noticing tasks that finished on the pool
+                try:
+                    mq.drain_events(timeout=Sync.DispatchWait)
+                except socket.timeout:
+                    if receivedUsers == finishedUsers:
+                        # (otherwise the running syncs' own heartbeats cover it)
+                        idleHeartbeat()
+                while not completedMessages.empty():
+                    completedMessages.get().ack()
+                    finishedUsers += 1
+        finally:
+            executor.shutdown()
+
+    def _idleHeartbeat(heartbeat_callback):
+        # The syncs report in as they go, but a worker with nothing to do needs to as well - otherwise it looks gone (see SyncQueueProbe.AdmissionLimit)
+        lastHeartbeat = datetime.utcnow()
+
+        def _heartbeat():
+            nonlocal lastHeartbeat
+            if heartbeat_callback and datetime.utcnow() - lastHeartbeat >= Sync.IdleHeartbeatInterval:
+                heartbeat_callback("ready")
+                lastHeartbeat = datetime.utcnow()
+        return _heartbeat
+
+    def _consumeLanes(callback, concurrency):
+        # The broker only sends as many users as there are slots to start them in, shared between all the queues - so a busy worker never sits on anyone another could be getting to.
+        # Each lane with users waiting then gets its turn as slots free up, so an interactive sync doesn't wait behind the whole periodic backlog.
+        # Lanes with a SYNC_LANE_SLOT_SHARE get their own, lower, limit on top of that, leaving the rest of the slots to the other lanes.
+        Sync._channel.basic_qos(0, concurrency, True)
+        Sync._consumers = []
+        for lane, laneQueue in [(None, Sync._host_queue)] + list(Sync._lane_queues.items()):
+            consumer = kombu.Consumer(
+                channel=Sync._channel,
+                queues=[laneQueue],
+                callbacks=[callback],
+                auto_declare=False
+            )
+            consumer.qos(prefetch_count=max(1, int(concurrency * SYNC_LANE_SLOT_SHARE.get(lane, 1))), apply_global=False)
+            consumer.consume()
+            Sync._consumers.append(consumer)
+
+    def SyncLane(user):
+        """ Which lane sync_scheduler should queue this user in """
+        # Full syncs (first-time ones especially) are the expensive ones, so they're kept apart from everything else
+        if user.get("NextSyncIsExhaustive", False) or not user.get("LastSynchronization", None):
+            return "exhaustive"
+        lane = user.get("NextSyncLane", None)
+        return lane if lane in SYNC_LANES else "periodic"
+
+    def LaneQueueName(lane):
+        return "tapiriik-users" if lane == "periodic" else "tapiriik-users-lane-%s" % lane
+
+    def LaneRoutingKey(lane):
+        # Periodic syncs go where everything used to
+        return "" if lane == "periodic" else "lane-%s" % lane
 
     def _consumeSyncTask(body, message, heartbeat_callback_direct, version):
         from tapiriik.auth import User
@@ -136,14 +273,12 @@ class Sync:
         user = User.Get(user_id)
         if user is None:
             logger.warning("Could not find user %s - bailing" % user_id)
-            message.ack() # Otherwise the entire thing grinds to a halt
-            return
+            return # The message gets acknowledged regardless, otherwise the entire thing grinds to a halt
         if body["generation"] != user.get("QueuedGeneration", None):
             # QueuedGeneration being different means they've gone through sync_scheduler since this particular message was queued
             # So, discard this and wait for that message to surface
             # Should only happen when I manually requeue people
             logger.warning("Queue generation mismatch for %s - bailing" % user_id)
-            message.ack()
             return
 
         def heartbeat_callback(state):
@@ -166,16 +301,22 @@ class Sync:
             exhaustive = True
 
         result = None
+        user_log = UserSyncLog(user_id)
         try:
-            result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback)
+            result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback, user_log=user_log)
         finally:
             nextSync = None
             if User.HasActivePayment(user):
                 if User.GetConfiguration(user)["suppress_auto_sync"]:
                     logger.info("Not scheduling auto sync for paid user")
                 else:
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
-            if result and result.ForceNextSync:
+                    syncInterval = SyncIntervalPolicy.Interval(user)
+                    # The jitter scales with the interval, so stretched-out users don't all bunch back up
+                    syncIntervalJitter = Sync.SyncIntervalJitter * (syncInterval / Sync.SyncInterval)
+                    # ...and goes to whichever slot in that range has the fewest users due, rather than wherever
+                    nextSync = SyncSlotHistogram.Place(datetime.utcnow() + syncInterval, syncIntervalJitter)[0]
+                    logger.info("Scheduling auto sync in %s" % syncInterval)
+            if result and result.ForceNextSync and (nextSync is None or result.ForceNextSync < nextSync):
                 logger.info("Forcing next sync at %s" % result.ForceNextSync)
                 nextSync = result.ForceNextSync
             reschedule_update = {
@@ -184,10 +325,14 @@ class Sync:
                     "LastSynchronization": datetime.utcnow(),
                     "LastSynchronizationVersion": version
                 }, "$unset": {
-                    "QueuedAt": None # Set by sync_scheduler when the record enters the MQ
+                    "QueuedAt": None, # Set by sync_scheduler when the record enters the MQ
+                    "NextSyncLane": None # Back to the periodic lane, unless something else comes up in the meantime
                 }
             }
 
+            if result:
+                reschedule_update["$set"].update(SyncIntervalPolicy.HistoryUpdate(user, result))
+
             if result and result.ForceExhaustive:
                 logger.info("Forcing next sync as exhaustive")
                 reschedule_update["$set"]["NextSyncIsExhaustive"] = True
@@ -198,21 +343,23 @@ class Sync:
                 {
                     "_id": user["_id"]
                 }, reschedule_update)
+            RedisSyncSchedule.Schedule([user["_id"]], nextSync)
             reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
 
-            # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
-            user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
-            user_log.write("\n%s\n" % reschedule_confirm_message)
-            user_log.close()
+            # Tack this on the end of the log since otherwise it's lost for good
+            user_log.Write("\n%s\n" % reschedule_confirm_message)
+            user_log.Close()
 
             logger.debug(reschedule_confirm_message)
             syncTime = (datetime.utcnow() - syncStart).total_seconds()
             db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
 
-        message.ack()
+            # Free up this user's slot in the worker's heartbeat record
+            if heartbeat_callback_direct:
+                heartbeat_callback_direct("ready", user_id)
 
-    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None):
-        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
+    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None, user_log=None):
+        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback, user_log=user_log)
 
 
 class SynchronizationTask:
@@ -222,6 +369,15 @@ class SynchronizationTask:
     def __init__(self, user):
         self.user = user
 
+    @property
+    def _activities(self):
+        # Sorted most recent first
+        return self._activityIndex.Activities()
+
+    @_activities.setter
+    def _activities(self, activities):
+        self._activityIndex = DuplicateActivityIndex(activities)
+
     def _lockUser(self):
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
 
@@ -241,18 +397,39 @@ class SynchronizationTask:
         self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}})]
 
     def _updateSyncProgress(self, step, progress):
+        if not self._progressReportThrottle.ShouldReport(step, progress):
+            return
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
 
-    def _initializeUserLogging(self):
-        self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=5, encoding="utf-8")
-        self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
-        self._logging_file_handler.doRollover()
-        _global_logger.addHandler(self._logging_file_handler)
+    def _throttleHeartbeat(self, heartbeat_callback):
+        def _heartbeat_callback(state):
+            if self._heartbeatReportThrottle.ShouldReport(state):
+                heartbeat_callback(state)
+        return _heartbeat_callback
+
+    def _initializeUserLogging(self, user_log=None):
+        # If we're handed a log, whoever did so is going to close it
+        self._owns_user_log = user_log is None
+        self._user_log = user_log if user_log else UserSyncLog(self.user["_id"])
+        self._logging_handler = UserSyncLogHandler(self._user_log, USER_SYNC_LOG_LEVEL)
+        self._logging_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
+        self._logging_handler.addFilter(_SyncTaskLogFilter(self))
+        _global_logger.addHandler(self._logging_handler)
+
+    def _inTaskContext(self, target):
+        # For anything run on another thread, so its logging ends up in this user's log
+        def _target(*args, **kwargs):
+            _syncTaskContext.task = self
+            try:
+                return target(*args, **kwargs)
+            finally:
+                _syncTaskContext.task = None
+        return _target
 
     def _closeUserLogging(self):
-        _global_logger.removeHandler(self._logging_file_handler)
-        self._logging_file_handler.flush()
-        self._logging_file_handler.close()
+        _global_logger.removeHandler(self._logging_handler)
+        if self._owns_user_log:
+            self._user_log.Close()
 
     def _loadExtendedAuthData(self):
         self._extendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": self._connectedServiceIds}}))
@@ -281,6 +458,7 @@ class SynchronizationTask:
                 del conn.ExcludedActivities  # Otherwise the exception messages get really, really, really huge and break mongodb.
 
     def _writeBackSyncErrorsAndExclusions(self):
+        self._writeBuffer.Flush()
         nonblockingSyncErrorsCount = 0
         forcingExhaustiveSyncErrorsCount = 0
         blockingSyncErrorsCount = 0
@@ -322,9 +500,15 @@ class SynchronizationTask:
                     "Exception": _packUserException(presc.UserException)
                 }) for svcId, presc in prescences.items()])
 
-        self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
+        # Each activity gets its own document - only the ones this sync actually dealt with need writing
+        writes = []
+        for x in self._activityRecords:
+            if not x.Touched and not self._migrateLegacyActivityRecords:
+                continue
+            if not hasattr(x, "_id"):
+                x._id = ObjectId()
+            writes.append(pymongo.ReplaceOne({"_id": x._id}, {
+                "UserID": self.user["_id"],
                 "StartTime": x.StartTime,
                 "EndTime": x.EndTime,
                 "Type": x.Type,
@@ -337,54 +521,85 @@ class SynchronizationTask:
                 "Prescence": _activityPrescences(x.PresentOnServices),
                 "Abscence": _activityPrescences(x.NotPresentOnServices),
                 "FailureCounts": x.FailureCounts
-            }
-            for x in self._activityRecords
-        ]
+            }, upsert=True))
 
-        db.activity_records.update(
-            {"UserID": self.user["_id"]},
-            {
-                "$set": {
-                    "UserID": self.user["_id"],
-                    "Activities": composed_records
-                }
-            },
-            upsert=True
-        )
+        if self._droppedActivityRecordIDs:
+            writes.append(pymongo.DeleteMany({"_id": {"$in": self._droppedActivityRecordIDs}}))
+
+        if writes:
+            db.user_activity_records.bulk_write(writes, ordered=False)
+
+        if self._migrateLegacyActivityRecords:
+            # Everything's in user_activity_records now
+            db.activity_records.remove({"UserID": self.user["_id"]})
 
     def _initializeActivityRecords(self):
-        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
         self._activityRecords = []
-        if not raw_records:
-            return
-        else:
-            raw_records = raw_records["Activities"]
-            for raw_record in raw_records:
+        self._activityRecordsByUID = {}
+        self._droppedActivityRecordIDs = []
+        self._migrateLegacyActivityRecords = False
+
+    def _loadActivityRecords(self, exhaustive):
+        # Records used to be stored as one big array per user - they're moved over the first time the user is synced
+        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
+        if raw_records:
+            self._migrateLegacyActivityRecords = True
+            for raw_record in raw_records["Activities"]:
                 if "UIDs" not in raw_record:
                     continue # From the few days where this was rolled out without this key...
-                rec = ActivityRecord(raw_record)
-                rec.UIDs = set(rec.UIDs)
-                # Did I mention I should really start using an ORM-type deal any day now?
-                for svc, absent in rec.Abscence.items():
-                    rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
-                for svc, present in rec.Prescence.items():
-                    rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
-                del rec.Prescence
-                del rec.Abscence
-                rec.Touched = False
-                self._activityRecords.append(rec)
+                self._appendActivityRecord(self._unpackActivityRecord(raw_record))
+            return
+
+        query = {"UserID": self.user["_id"]}
+        if not exhaustive:
+            # Only load the records that could belong to something we listed - the rest are left be on write-back.
+            # Exhaustive syncs need everything, to clear out the records that no longer belong to anything.
+            if not self._activities:
+                return
+            # Naive start times get stored as-is, so leave some room for the TZ to be off
+            query["StartTime"] = {"$gte": min(x.StartTime.replace(tzinfo=None) for x in self._activities) - timedelta(days=2)}
+        for raw_record in db.user_activity_records.find(query).sort("StartTime", -1):
+            self._appendActivityRecord(self._unpackActivityRecord(raw_record))
+
+    def _unpackActivityRecord(self, raw_record):
+        rec = ActivityRecord(raw_record)
+        rec.UIDs = set(rec.UIDs)
+        # Did I mention I should really start using an ORM-type deal any day now?
+        for svc, absent in rec.Abscence.items():
+            rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
+        for svc, present in rec.Prescence.items():
+            rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
+        del rec.Prescence
+        del rec.Abscence
+        rec.Touched = False
+        return rec
+
+    def _appendActivityRecord(self, record):
+        record.Ordinal = len(self._activityRecords)
+        self._activityRecords.append(record)
+        self._indexActivityRecord(record)
+
+    def _indexActivityRecord(self, record):
+        # Call whenever the record's UIDs grow or are replaced - stale entries are weeded out on lookup
+        for uid in record.UIDs:
+            indexedRecords = self._activityRecordsByUID.setdefault(uid, [])
+            if record not in indexedRecords:
+                indexedRecords.append(record)
 
     def _findOrCreateActivityRecord(self, activity):
-        for record in self._activityRecords:
-            if record.UIDs & activity.UIDs:
-                record.Touched = True
-                return record
+        candidates = [record for uid in activity.UIDs for record in self._activityRecordsByUID.get(uid, []) if record.UIDs & activity.UIDs]
+        if candidates:
+            # The first matching record in the list wins, same as ever
+            record = min(candidates, key=lambda x: x.Ordinal)
+            record.Touched = True
+            return record
         record = ActivityRecord.FromActivity(activity)
         record.Touched = True
-        self._activityRecords.append(record)
+        self._appendActivityRecord(record)
         return record
 
     def _dropUntouchedActivityRecords(self):
+        self._droppedActivityRecordIDs += [x._id for x in self._activityRecords if not x.Touched and hasattr(x, "_id")]
         self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
 
     def _persistServiceTrigger(self, serviceRecord):
@@ -402,6 +617,15 @@ class SynchronizationTask:
     def _getServiceExclusionUserException(self, serviceRecord):
         return self._excludedServices[serviceRecord._id]
 
+    def _synchronizedActivityUIDs(self, conn):
+        # Which of this sync's UIDs are known to be on the connection - see _loadSynchronizedActivities (and kept up to date as we synchronize more).
+        # Plus whatever's still in the connection's own SynchronizedActivities list, from before they got their own collection.
+        if not hasattr(self, "_synchronizedActivityUIDsByConnection"):
+            self._synchronizedActivityUIDsByConnection = {}
+        if conn._id not in self._synchronizedActivityUIDsByConnection:
+            self._synchronizedActivityUIDsByConnection[conn._id] = set(getattr(conn, "SynchronizedActivities", None) or [])
+        return self._synchronizedActivityUIDsByConnection[conn._id]
+
     def _determineRecipientServices(self, activity):
         recipientServices = []
         for conn in self._serviceConnections:
@@ -411,7 +635,7 @@ class SynchronizationTask:
             if conn._id in activity.ServiceDataCollection:
                 # The activity record is updated earlier for these, blegh.
                 continue
-            elif hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            elif not self._synchronizedActivityUIDs(conn).isdisjoint(activity.UIDs):
                 continue
             elif activity.Type not in conn.Service.SupportedActivities:
                 logger.debug("\t...%s doesn't support type %s" % (conn.Service.ID, activity.Type))
@@ -440,10 +664,6 @@ class SynchronizationTask:
             return a
 
     def _accumulateActivities(self, conn, svcActivities, no_add=False):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        activityStartTZOffsetLeeway = timedelta(minutes=1)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
         for act in svcActivities:
             act.UIDs = set([act.UID])
@@ -457,59 +677,7 @@ class SynchronizationTask:
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            # Binsearch to find which activities actually need individual attention.
-            # Otherwise it's O(mn^2).
-            # self._activities is sorted most recent first
-            relevantActivitiesStart = bisect.bisect_left(self._activities, act.StartTime + timezoneErrorPeriod)
-            relevantActivitiesEnd = bisect.bisect_right(self._activities, act.StartTime - timezoneErrorPeriod, lo=relevantActivitiesStart)
-            extantActIter = (
-                              x for x in (self._activities[idx] for idx in range(relevantActivitiesStart, relevantActivitiesEnd)) if
-                              (
-                                  # Identical
-                                  x.UID == act.UID
-                                  or
-                                  # Check to see if the self._activities are reasonably close together to be considered duplicate
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime-x.StartTime) < activityStartLeeway
-                                  )
-                                  or
-                                  # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                                  )
-                                  or
-                                  # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                                  # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                                  #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                                  # There's a very low chance that two activities in this period would intersect and be merged together.
-                                  # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < activityStartTZOffsetLeeway
-                                   )
-                                  or
-                                  # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2)
-                                   )
-                               )
-                                and
-                                # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
-                                (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
-                              )
-
-            try:
-                existingActivity = next(extantActIter)
-            except StopIteration:
-                existingActivity = None
+            existingActivity = self._activityIndex.FindDuplicate(act)
 
             if existingActivity:
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
@@ -548,9 +716,12 @@ class SynchronizationTask:
 
                 existingActivity.UIDs |= act.UIDs  # I think this is merited
                 act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
+                if hasattr(existingActivity, "Record") and existingActivity.Record.UIDs is existingActivity.UIDs:
+                    self._indexActivityRecord(existingActivity.Record)
+                self._activityIndex.Update(existingActivity) # StartTime / UID may have changed above
                 continue
             if not no_add:
-                bisect.insort_left(self._activities, act)
+                self._activityIndex.Add(act)
 
     def _determineEligibleRecipientServices(self, activity, recipientServices):
         from tapiriik.auth import User
@@ -630,7 +801,7 @@ class SynchronizationTask:
                 # The connection never gets saved in full again, so we can sub these in here at no risk.
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
-    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+    def _shouldDownloadActivityList(self, conn, exhaustive):
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
@@ -640,31 +811,38 @@ class SynchronizationTask:
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service]:
             logger.info("Service %s is blocked:" % conn.Service.ID)
             self._excludeService(conn, _unpackUserException([x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service][0]))
-            return
+            return False
 
         if svc.ID in DISABLED_SERVICES or svc.ID in WITHDRAWN_SERVICES:
             logger.info("Service %s is widthdrawn" % conn.Service.ID)
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
 
         if exhaustive and not svc.SupportsExhaustiveListing and not self._activities:
             # If we get to this point, we must already have activity listings from another service.
             logger.info("Account does not contain any services supporting exhaustive activity listing")
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
 
         if svc.RequiresExtendedAuthorizationDetails:
             if not conn.ExtendedAuthorization:
                 logger.info("No extended auth details for " + svc.ID)
                 self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
-                return
+                return False
+        return True
+
+    def _activityListBounds(self, exhaustive):
+        if not exhaustive or not self._activities:
+            return exhaustive
+        return min((x.StartTime.replace(tzinfo=None) for x in self._activities))
 
+    def _retrieveActivityList(self, conn, listBounds):
+        # This doesn't touch any of the task's state, so it can be run off the main thread.
+        # Returns (activities, exclusions, packed exception, UserException to exclude the service with)
+        svc = conn.Service
         try:
             logger.info("\tRetrieving list from " + svc.ID)
-            if not exhaustive or not self._activities:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
-            else:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, min((x.StartTime.replace(tzinfo=None) for x in self._activities)))
+            svcActivities, svcExclusions = svc.DownloadActivityList(conn, listBounds)
         except (ServiceException, ServiceWarning) as e:
             # Special-case rate limiting errors thrown during listing
             # Otherwise, things will melt down when the limit is reached
@@ -678,17 +856,55 @@ class SynchronizationTask:
 
             if e.UserException and e.UserException.Type == UserExceptionType.RateLimited:
                 e.TriggerExhaustive = conn._id in self._hasTransientSyncErrors and self._hasTransientSyncErrors[conn._id]
-            self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
-            self._excludeService(conn, e.UserException)
-            if not _isWarning(e):
-                return
+            return [], [], _packServiceException(SyncStep.List, e), e.UserException
         except Exception as e:
-            self._syncErrors[conn._id].append(_packException(SyncStep.List))
-            self._excludeService(conn, UserException(UserExceptionType.ListingError))
+            return [], [], _packException(SyncStep.List), UserException(UserExceptionType.ListingError)
+        return svcActivities, svcExclusions, None, None
+
+    def _accumulateActivityList(self, conn, activityList, no_add=False):
+        svcActivities, svcExclusions, packedException, userException = activityList
+        if packedException:
+            self._syncErrors[conn._id].append(packedException)
+            self._excludeService(conn, userException)
             return
         self._accumulateExclusions(conn, svcExclusions)
         self._accumulateActivities(conn, svcActivities, no_add=no_add)
 
+    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+        if not self._shouldDownloadActivityList(conn, exhaustive):
+            return
+        activityList = self._retrieveActivityList(conn, self._activityListBounds(exhaustive))
+        self._accumulateActivityList(conn, activityList, no_add=no_add)
+
+    def _downloadActivityListsConcurrently(self, conns, exhaustive, heartbeat_callback=None):
+        # Only the remote calls happen concurrently - the results are merged in the same order as they would be sequentially.
+        # So, deduplication works out exactly the same as it does otherwise.
+        conns = [x for x in conns if self._shouldDownloadActivityList(x, exhaustive)]
+        if not conns:
+            return
+        if exhaustive and not self._activities:
+            # Listed one at a time, every connection after the first would only go back as far as the activities found before it (see _activityListBounds).
+            # So the first is listed on its own, and the rest go back as far as it found - rather than all the way.
+            # (that's never further than they'd go one at a time, though it can fall short if the later ones have older activities than the first)
+            self._retrieveAndAccumulateActivityLists(conns[:1], self._activityListBounds(exhaustive), heartbeat_callback=heartbeat_callback)
+            conns = conns[1:]
+        if conns:
+            self._retrieveAndAccumulateActivityLists(conns, self._activityListBounds(exhaustive), heartbeat_callback=heartbeat_callback)
+
+    def _retrieveAndAccumulateActivityLists(self, conns, listBounds, heartbeat_callback=None):
+        with ThreadPoolExecutor(max_workers=min(len(conns), SYNC_LISTING_CONCURRENCY)) as executor:
+            pendingLists = [(conn, executor.submit(self._inTaskContext(self._retrieveActivityList), conn, listBounds)) for conn in conns]
+            for conn, pendingList in pendingLists:
+                # Same as in the sequential case - if everything else has fallen through, there's no point in merging this.
+                if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                    for _, remainingList in pendingLists:
+                        remainingList.cancel()
+                    raise SynchronizationCompleteException()
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.List)
+                self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                self._accumulateActivityList(conn, pendingList.result())
+
     def _estimateFallbackTZ(self, activities):
         from collections import Counter
         # With the hope that the majority of the activity records returned will have TZs, and the user's current TZ will constitute the majority.
@@ -712,34 +928,42 @@ class SynchronizationTask:
         # Locally mark this activity as present on the appropriate services.
         # These needs to happen regardless of whether the activity is going to be synchronized.
         #   Before, I had moved this under all the eligibility/recipient checks, but that could cause persistent duplicate self._activities when the user had already manually uploaded the same activity to multiple sites.
-        updateServicesWithExistingActivity = False
-        for serviceWithExistingActivityId in activity.ServiceDataCollection.keys():
-            serviceWithExistingActivity = [x for x in self._serviceConnections if x._id == serviceWithExistingActivityId][0]
-            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not (activity.UIDs <= set(serviceWithExistingActivity.SynchronizedActivities)):
-                updateServicesWithExistingActivity = True
-                break
-
-        if updateServicesWithExistingActivity:
-            logger.debug("\t\tUpdating SynchronizedActivities")
-            try:
-                db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}},
-                                      {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}},
-                                      multi=True)
-            except pymongo.errors.WriteError as e:
-                if e.code == 17419: # Update makes document too large.
-                    # Throw them all out - exhaustive sync will recover.
-                    # I should probably check that this is actually due to transient issues - otherwise it'll keep happening.
-                    db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}}, {"$unset": {"SynchronizedActivities": ""}})
-                    self._sync_result.ForceExhaustive = True
-                else:
-                    raise
+        for conn in self._serviceConnections:
+            if conn._id in activity.ServiceDataCollection:
+                self._markActivitySynchronized(conn, activity)
+
+    def _markActivitySynchronized(self, conn, activity):
+        synchronizedUIDs = self._synchronizedActivityUIDs(conn)
+        newUIDs = activity.UIDs - synchronizedUIDs
+        if not newUIDs:
+            return
+        logger.debug("\t\tUpdating SynchronizedActivities for %s" % conn.Service.ID)
+        for uid in newUIDs:
+            self._writeBuffer.Update(db.synchronized_activities, {"ConnectionID": conn._id, "UID": uid}, {"$setOnInsert": {"Timestamp": datetime.utcnow()}}, upsert=True, error_handler=_ignoreDuplicateKeyError)
+        synchronizedUIDs.update(newUIDs)
+
+    def _migrateSynchronizedActivities(self):
+        # Connections used to hold the whole list themselves - move those over as we come across them
+        for conn in self._serviceConnections:
+            if getattr(conn, "SynchronizedActivities", None):
+                db.synchronized_activities.bulk_write([pymongo.UpdateOne({"ConnectionID": conn._id, "UID": uid}, {"$setOnInsert": {"Timestamp": datetime.utcnow()}}, upsert=True) for uid in set(conn.SynchronizedActivities)], ordered=False)
+            if hasattr(conn, "SynchronizedActivities"):
+                db.connections.update({"_id": conn._id}, {"$unset": {"SynchronizedActivities": ""}})
+
+    def _loadSynchronizedActivities(self):
+        connectionsByID = dict((conn._id, conn) for conn in self._serviceConnections)
+        # We only need to know about the UIDs that are actually in play this sync
+        listedUIDs = list(set(uid for activity in self._activities for uid in activity.UIDs))
+        for batchStart in range(0, len(listedUIDs), SYNCHRONIZED_ACTIVITIES_QUERY_BATCH_SIZE):
+            for record in db.synchronized_activities.find({"ConnectionID": {"$in": list(connectionsByID.keys())}, "UID": {"$in": listedUIDs[batchStart:batchStart + SYNCHRONIZED_ACTIVITIES_QUERY_BATCH_SIZE]}}, {"ConnectionID": 1, "UID": 1}):
+                self._synchronizedActivityUIDs(connectionsByID[record["ConnectionID"]]).add(record["UID"])
 
     def _updateActivityRecordInitialPrescence(self, activity):
         for connWithExistingActivityId in activity.ServiceDataCollection.keys():
             connWithExistingActivity = [x for x in self._serviceConnections if x._id == connWithExistingActivityId][0]
             activity.Record.MarkAsPresentOn(connWithExistingActivity)
         for conn in self._serviceConnections:
-            if hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            if not self._synchronizedActivityUIDs(conn).isdisjoint(activity.UIDs):
                 activity.Record.MarkAsPresentOn(conn)
 
     def _syncActivityRedisKey(user):
@@ -753,8 +977,7 @@ class SynchronizationTask:
     def RecentSyncActivity(user):
         return [json.loads(x.decode("UTF-8")) for x in redis.lrange(SynchronizationTask._syncActivityRedisKey(user), 0, 4)]
 
-    def _downloadActivity(self, activity):
-        act = None
+    def _activityDownloadSources(self, activity):
         actAvailableFromSvcIds = activity.ServiceDataCollection.keys()
         actAvailableFromSvcs = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromSvcIds]
 
@@ -763,34 +986,84 @@ class SynchronizationTask:
 
         # TODO: redo this, it was completely broken:
         # Prefer retrieving the activity from its original source.
+        return actAvailableFromSvcs
 
-        for dlSvcRecord in actAvailableFromSvcs:
-            dlSvc = dlSvcRecord.Service
-            logger.info("\tfrom " + dlSvc.ID)
-            if not dlSvc.SuppliesActivities:
+    def _skipActivityDownloadSource(self, activity, dlSvcRecord, mark=True):
+        # Whether this source should be passed over - and if mark is set, the activity record says why
+        dlSvc = dlSvcRecord.Service
+        if not dlSvc.SuppliesActivities:
+            if mark:
                 activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.NoSupplier))
                 logger.info("\t\t...does not supply activities")
-                continue
-            if activity.UID in self._syncExclusions[dlSvcRecord._id]:
+            return True
+        if activity.UID in self._syncExclusions[dlSvcRecord._id]:
+            if mark:
                 activity.Record.MarkAsNotPresentOtherwise(_unpackUserException(self._syncExclusions[dlSvcRecord._id][activity.UID]))
                 logger.info("\t\t...has activity exclusion logged")
-                continue
-            if self._isServiceExcluded(dlSvcRecord):
+            return True
+        if self._isServiceExcluded(dlSvcRecord):
+            if mark:
                 activity.Record.MarkAsNotPresentOtherwise(self._getServiceExclusionUserException(dlSvcRecord))
                 logger.info("\t\t...service became excluded after listing") # Because otherwise we'd never have been trying to download from it in the first place.
-                continue
-            if activity.Record.GetFailureCount(dlSvcRecord) >= dlSvc.DownloadRetryCount:
-                # We don't re-call MarkAsNotPresentOtherwise here
-                # ...since its existing value will be the more illuminating as to the error
-                # (and we can just check the failure count if we want to know if it's being ignored)
+            return True
+        if activity.Record.GetFailureCount(dlSvcRecord) >= dlSvc.DownloadRetryCount:
+            # We don't re-call MarkAsNotPresentOtherwise here
+            # ...since its existing value will be the more illuminating as to the error
+            # (and we can just check the failure count if we want to know if it's being ignored)
+            if mark:
                 logger.info("\t\t...download retry count exceeded")
+            return True
+        return False
+
+    def _activityWorkingCopy(self, activity, dlSvcRecord):
+        workingCopy = copy.copy(activity)  # we can hope
+        # Load in the service data in the same place they left it.
+        workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+        return workingCopy
+
+    def _retrieveActivity(self, dlSvcRecord, workingCopy, countWaypoints=False):
+        # Just the remote call - this doesn't touch any of the task's state (bar the pipeline's waypoint count), so it can be run off the main thread.
+        workingCopy = dlSvcRecord.Service.DownloadActivity(dlSvcRecord, workingCopy)
+        # It might be a while before this activity makes it out of the pipeline
+        workingCopy.CompactWaypoints()
+        if countWaypoints:
+            with self._pipelineWaypointsLock:
+                self._pipelineWaypoints += workingCopy.CountTotalWaypoints()
+        return workingCopy
+
+    def _prefetchActivity(self, activity, downloadExecutor):
+        # Starts downloading the activity from whichever source _downloadActivity will most likely try first, while the activities ahead of it are uploaded.
+        # Everything else _downloadActivity does waits for it to come out of the pipeline, so the task's state is only ever touched from this thread.
+        for dlSvcRecord in self._activityDownloadSources(activity):
+            if not self._skipActivityDownloadSource(activity, dlSvcRecord, mark=False):
+                workingCopy = self._activityWorkingCopy(activity, dlSvcRecord)
+                return dlSvcRecord, workingCopy, downloadExecutor.submit(self._inTaskContext(self._retrieveActivity), dlSvcRecord, workingCopy, countWaypoints=True)
+        return None
+
+    def _releasePrefetchedActivity(self, prefetchedDownload):
+        # Once it's out of the pipeline, it no longer counts against SYNC_PIPELINE_WAYPOINT_LIMIT
+        _, _, pendingDownload = prefetchedDownload
+        if not pendingDownload.exception():
+            with self._pipelineWaypointsLock:
+                self._pipelineWaypoints -= pendingDownload.result().CountTotalWaypoints()
+
+    def _downloadActivity(self, activity, prefetchedDownload=None):
+        act = None
+        for dlSvcRecord in self._activityDownloadSources(activity):
+            dlSvc = dlSvcRecord.Service
+            logger.info("\tfrom " + dlSvc.ID)
+            # (checked again, even if it was prefetched - things may have changed while it waited in the pipeline)
+            if self._skipActivityDownloadSource(activity, dlSvcRecord):
                 continue
 
-            workingCopy = copy.copy(activity)  # we can hope
-            # Load in the service data in the same place they left it.
-            workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+            if prefetchedDownload and prefetchedDownload[0] is dlSvcRecord:
+                _, workingCopy, pendingDownload = prefetchedDownload
+            else:
+                workingCopy = self._activityWorkingCopy(activity, dlSvcRecord)
+                pendingDownload = None
             try:
-                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+                # Exceptions raised in the background come back out here, so they're handled just the same
+                workingCopy = pendingDownload.result() if pendingDownload else self._retrieveActivity(dlSvcRecord, workingCopy)
             except (ServiceException, ServiceWarning) as e:
                 if not _isWarning(e):
                     # Persist the exception if we just exceeded the failure count
@@ -846,10 +1119,13 @@ class SynchronizationTask:
         # If nothing was downloaded at this point, the activity record will show the most recent error - which is fine enough, since only one service is needed to get the activity.
         return act, dlSvc
 
-    def _uploadActivity(self, activity, destinationServiceRec):
+    def _uploadActivity(self, activity, destinationServiceRec, pendingUpload=None):
         destSvc = destinationServiceRec.Service
 
         try:
+            if pendingUpload:
+                # Started elsewhere - this re-raises whatever it raised, so the bookkeeping below still happens here
+                return pendingUpload.result()
             return destSvc.UploadActivity(destinationServiceRec, activity)
         except (ServiceException, ServiceWarning) as e:
             if not _isWarning(e):
@@ -880,10 +1156,144 @@ class SynchronizationTask:
 
         activity.Record.ResetFailureCount(destinationServiceRec)
 
-    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
-        from tapiriik.auth import User
+    def _finishActivity(self, activity, eligibleServices, prefetchedDownload, heartbeat_callback=None):
+        # Returns the number of activities this counts for as far as sync progress is concerned
+        full_activity, activitySource = self._downloadActivity(activity, prefetchedDownload)
+        if prefetchedDownload:
+            self._releasePrefetchedActivity(prefetchedDownload)
+
+        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
+            # The activity record gets updated in _downloadActivity
+            return 1  # we tried
+
+        try:
+            self._uploadDownloadedActivity(activity, eligibleServices, full_activity, activitySource, heartbeat_callback=heartbeat_callback)
+        except ActivityShouldNotSynchronizeException:
+            return 0
+        return 1
+
+    def _isActivityPipelineFull(self, pendingActivities):
+        if len(pendingActivities) >= SYNC_PIPELINE_DEPTH:
+            return True
+        # Full activities can be massive, so cap how many waypoints we'll hold on to while waiting for uploads, too.
+        # (kept count of as the downloads complete - see _retrieveActivity)
+        return self._pipelineWaypoints >= SYNC_PIPELINE_WAYPOINT_LIMIT
+
+    def _finishPendingActivities(self, pendingActivities, heartbeat_callback=None, drain=False):
+        # Uploads activities from the front of the pipeline until there's room to download another (or until it's empty, if draining)
+        processedActivities = 0
+        while pendingActivities and (drain or self._isActivityPipelineFull(pendingActivities)):
+            processedActivities += self._finishActivity(*pendingActivities.popleft(), heartbeat_callback=heartbeat_callback)
+        return processedActivities
+
+    def _activityUploadCopy(self, activity):
+        # What each concurrent upload is handed - its own activity and laps, so an adapter setting something on them can't affect the others.
+        # The waypoints (the bulk of it) are shared rather than copied per destination: the uploaders and file writers only read them.
+        uploadCopy = copy.copy(activity)
+        uploadCopy.Laps = [copy.copy(lap) for lap in activity.Laps]
+        return uploadCopy
+
+    def _uploadDownloadedActivity(self, activity, eligibleServices, full_activity, activitySource, heartbeat_callback=None):
         from tapiriik.services.interchange import ActivityStatisticUnit
 
+        full_activity.CleanStats()
+        full_activity.CleanWaypoints()
+
+        try:
+            full_activity.EnsureTZ()
+        except Exception as e:
+            logger.error("\tCould not determine TZ %s" % e)
+            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
+            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+            raise ActivityShouldNotSynchronizeException()
+        else:
+            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+
+        try:
+            full_activity.CheckTimestampSanity()
+        except ValueError as e:
+            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
+            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
+            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+            # raise ActivityShouldNotSynchronizeException()
+
+        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+        self._indexActivityRecord(activity.Record)
+
+        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
+
+        successful_destination_service_ids = []
+        uploadDestinations = []
+
+        for destinationSvcRecord in eligibleServices:
+            if heartbeat_callback:
+                heartbeat_callback(SyncStep.Upload)
+            destSvc = destinationSvcRecord.Service
+            if self._isServiceExcluded(destinationSvcRecord):
+                # Another activity's upload may have gotten this service excluded since this one was checked for eligibility
+                logger.info("\t\t...%s became excluded while downloading" % destSvc.ID)
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, self._getServiceExclusionUserException(destinationSvcRecord))
+                continue
+            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
+                logger.info("\t\t...marked as stationary during download")
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
+                continue
+            if not full_activity.Stationary:
+                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
+                    logger.info("\t\t...marked as non-GPS during download")
+                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
+                    continue
+            uploadDestinations.append(destinationSvcRecord)
+
+        uploadExecutor = None
+        pendingUploads = {}
+        if SYNC_UPLOAD_CONCURRENCY > 1 and len(uploadDestinations) > 1:
+            # The destinations are independent, so the remote calls can all go at once.
+            # Everything else (failure counts, the activity record, etc.) is still handled below, one destination at a time.
+            uploadExecutor = ThreadPoolExecutor(max_workers=min(len(uploadDestinations), SYNC_UPLOAD_CONCURRENCY))
+            for destinationSvcRecord in uploadDestinations:
+                logger.info("\t  Uploading to " + destinationSvcRecord.Service.ID)
+                pendingUploads[destinationSvcRecord._id] = uploadExecutor.submit(self._inTaskContext(destinationSvcRecord.Service.UploadActivity), destinationSvcRecord, self._activityUploadCopy(full_activity))
+
+        try:
+            for destinationSvcRecord in uploadDestinations:
+                destSvc = destinationSvcRecord.Service
+                uploaded_external_id = None
+                if uploadExecutor:
+                    if heartbeat_callback:
+                        heartbeat_callback(SyncStep.Upload)
+                else:
+                    logger.info("\t  Uploading to " + destSvc.ID)
+                try:
+                    uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord, pendingUpload=pendingUploads.get(destinationSvcRecord._id))
+                except UploadException:
+                    continue # At this point it's already been added to the error collection, so we can just bail.
+                logger.info("\t  Uploaded to " + destSvc.ID)
+
+                activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
+                successful_destination_service_ids.append(destSvc.ID)
+
+                if uploaded_external_id:
+                    # record external ID, for posterity (and later debugging)
+                    self._writeBuffer.Insert(db.uploaded_activities, {"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
+                # flag as successful
+                self._markActivitySynchronized(destinationSvcRecord, activity)
+
+                self._writeBuffer.Update(db.sync_stats, {"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
+        finally:
+            if uploadExecutor:
+                uploadExecutor.shutdown()
+            if len(successful_destination_service_ids):
+                # Don't sit on the record of a completed upload - if this worker dies, the next sync would upload it all over again.
+                self._writeBuffer.Flush()
+
+        if len(successful_destination_service_ids):
+            self._sync_result.ActivitiesSynchronized += 1
+            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
+
+    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, user_log=None):
+        from tapiriik.auth import User
+
         if len(self.user["ConnectedServices"]) <= 1:
             return # Done and done!
 
@@ -895,19 +1305,28 @@ class SynchronizationTask:
         # Mark this user as in-progress.
         self._lockUser()
 
+        # These get called for every activity (and upload) - only the ones with news are actually written
+        self._progressReportThrottle = _SyncReportThrottle()
+        self._heartbeatReportThrottle = _SyncReportThrottle()
+        if heartbeat_callback:
+            heartbeat_callback = self._throttleHeartbeat(heartbeat_callback)
+
         # Reset their progress
         self._updateSyncProgress(SyncStep.List, 0)
 
-        self._initializeUserLogging()
+        _syncTaskContext.task = self
+        self._initializeUserLogging(user_log)
 
         logger.info("Beginning sync for " + str(self.user["_id"]) + "(exhaustive: " + str(exhaustive) + ")")
 
         # Sets up serviceConnections
         self._loadServiceData()
+        sync_result.Triggered = any("TriggerPartialSync" in conn.__dict__ for conn in self._serviceConnections)
 
         self._loadExtendedAuthData()
 
         self._activities = []
+        self._writeBuffer = SyncWriteBuffer(SYNC_WRITE_BUFFER_SIZE, SYNC_WRITE_BUFFER_INTERVAL)
         self._excludedServices = {}
         self._deferredServices = []
         self._persistTriggerServices = {}
@@ -916,14 +1335,22 @@ class SynchronizationTask:
 
         self._initializeActivityRecords()
 
+        downloadExecutor = None
+
         try:
             try:
                 # Sort services that don't support exhaustive listing last.
                 # That way, we can provide them with the proper bounds for listing based
                 # on activities from other services.
+                # When listing concurrently, those that do support it are listed all at once before we get to that point.
+                concurrentListConns = []
                 for conn in sorted(self._serviceConnections,
                                    key=lambda x: x.Service.SupportsExhaustiveListing,
                                    reverse=True):
+                    if concurrentListConns and not conn.Service.SupportsExhaustiveListing:
+                        self._downloadActivityListsConcurrently(concurrentListConns, exhaustive, heartbeat_callback=heartbeat_callback)
+                        concurrentListConns = []
+
                     # If we're not going to be doing anything anyways, stop now
                     if len(self._serviceConnections) - len(self._excludedServices) <= 1:
                         raise SynchronizationCompleteException()
@@ -938,20 +1365,39 @@ class SynchronizationTask:
                         self._deferredServices.append(conn._id)
                         continue
 
+                    if SYNC_LISTING_CONCURRENCY > 1 and conn.Service.SupportsExhaustiveListing:
+                        concurrentListConns.append(conn)
+                        continue
+
                     if heartbeat_callback:
                         heartbeat_callback(SyncStep.List)
 
                     self._updateSyncProgress(SyncStep.List, conn.Service.ID)
                     self._downloadActivityList(conn, exhaustive)
 
+                if concurrentListConns:
+                    self._downloadActivityListsConcurrently(concurrentListConns, exhaustive, heartbeat_callback=heartbeat_callback)
+
                 self._applyFallbackTZ()
 
                 # Makes reading the logs much easier.
                 self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
 
+                # Now we know what period this sync covers
+                self._loadActivityRecords(exhaustive)
+                self._migrateSynchronizedActivities()
+                self._loadSynchronizedActivities()
+
                 totalActivities = len(self._activities)
                 processedActivities = 0
 
+                # Activities that are downloaded (or downloading), waiting to be uploaded - see SYNC_PIPELINE_DEPTH
+                pendingActivities = collections.deque()
+                self._pipelineWaypoints = 0
+                self._pipelineWaypointsLock = threading.Lock()
+                if SYNC_PIPELINE_DEPTH > 1:
+                    downloadExecutor = ThreadPoolExecutor(max_workers=1)
+
                 for activity in self._activities:
                     logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
                     logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
@@ -991,7 +1437,7 @@ class SynchronizationTask:
                                 if time_remaining > timedelta(0):
                                     activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Deferred))
                                     # Only reschedule if it won't slow down their auto-sync timing
-                                    if time_remaining < (Sync.SyncInterval + Sync.SyncIntervalJitter):
+                                    if time_remaining < SyncIntervalPolicy.Interval(self.user) + Sync.SyncIntervalJitter:
                                         next_sync = datetime.utcnow() + time_remaining
                                         # Reschedule them so this activity syncs immediately on schedule
                                         sync_result.ForceScheduleNextSyncOnOrBefore(next_sync)
@@ -1042,11 +1488,15 @@ class SynchronizationTask:
                             for conn in eligibleServices:
                                 if conn._id in self._deferredServices:
                                     logger.info("Doing deferred list from %s" % conn.Service.ID)
+                                    # This may merge into activities that are still being downloaded, so let those finish up first
+                                    processedActivities += self._finishPendingActivities(pendingActivities, heartbeat_callback=heartbeat_callback, drain=True)
                                     # no_add since...
                                     #  a) we're iterating over the list it'd be adding to, and who knows what will happen then
                                     #  b) for the current use of deferred services, we don't care about new activities
                                     self._downloadActivityList(conn, exhaustive, no_add=True)
                                     self._deferredServices.remove(conn._id)
+                                    # Which may have brought in UIDs we haven't looked up yet
+                                    self._loadSynchronizedActivities()
                                     has_deferred = True
 
                             # If we had deferred listing activities from a service, we have to repeat this loop to consider the new info
@@ -1070,84 +1520,17 @@ class SynchronizationTask:
                         # The second most important line of logging in the application...
                         logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
 
-                        # Download the full activity record
-                        full_activity, activitySource = self._downloadActivity(activity)
-
-                        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
-                            # The activity record gets updated in _downloadActivity
-                            processedActivities += 1  # we tried
-                            raise ActivityShouldNotSynchronizeException()
-
-                        full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
-
-                        try:
-                            full_activity.EnsureTZ()
-                        except Exception as e:
-                            logger.error("\tCould not determine TZ %s" % e)
-                            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
-                            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
-                            raise ActivityShouldNotSynchronizeException()
-                        else:
-                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        try:
-                            full_activity.CheckTimestampSanity()
-                        except ValueError as e:
-                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
-                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
-                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
-                            # raise ActivityShouldNotSynchronizeException()
-
-                        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
-
-                        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
-
-                        successful_destination_service_ids = []
-
-                        for destinationSvcRecord in eligibleServices:
-                            if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
-                            destSvc = destinationSvcRecord.Service
-                            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
-                                logger.info("\t\t...marked as stationary during download")
-                                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
-                                continue
-                            if not full_activity.Stationary:
-                                if not (destSvc.ReceivesNonGPSActivitiesWithOtherSensorData or full_activity.GPS):
-                                    logger.info("\t\t...marked as non-GPS during download")
-                                    activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
-                                    continue
-
-                            uploaded_external_id = None
-                            logger.info("\t  Uploading to " + destSvc.ID)
-                            try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
-                            except UploadException:
-                                continue # At this point it's already been added to the error collection, so we can just bail.
-                            logger.info("\t  Uploaded")
-
-                            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
-                            successful_destination_service_ids.append(destSvc.ID)
-
-                            if uploaded_external_id:
-                                # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-
-                        if len(successful_destination_service_ids):
-                            self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
-                        del full_activity
-                        processedActivities += 1
+                        # Download the full activity record - starting in the background, if the pipeline is enabled
+                        prefetchedDownload = self._prefetchActivity(activity, downloadExecutor) if downloadExecutor else None
+                        pendingActivities.append((activity, eligibleServices, prefetchedDownload))
+                        processedActivities += self._finishPendingActivities(pendingActivities, heartbeat_callback=heartbeat_callback)
                     except ActivityShouldNotSynchronizeException:
                         continue
                     finally:
                         del activity
 
+                processedActivities += self._finishPendingActivities(pendingActivities, heartbeat_callback=heartbeat_callback, drain=True)
+
             except SynchronizationCompleteException:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
@@ -1178,15 +1561,42 @@ class SynchronizationTask:
         else:
             logger.info("Finished sync for %s (worker %d)" % (self.user["_id"], os.getpid()))
         finally:
+            if downloadExecutor:
+                downloadExecutor.shutdown()
             self._closeUserLogging()
+            _syncTaskContext.task = None
 
         return sync_result
 
 
+class _SyncReportThrottle:
+    # Remembers what was last reported, so repeats can be skipped until there's a new step, meaningful progress, or it's been a while
+    def __init__(self):
+        self._lastStep = None
+        self._lastProgress = None
+        self._lastReport = None
+
+    def ShouldReport(self, step, progress=None):
+        now = datetime.utcnow()
+        if self._lastReport is not None and step == self._lastStep and now - self._lastReport < timedelta(seconds=SYNC_PROGRESS_REPORT_INTERVAL):
+            if progress == self._lastProgress:
+                return False
+            # During listing the progress is which service we're on - any change there is news
+            if isinstance(progress, (int, float)) and isinstance(self._lastProgress, (int, float)) and abs(progress - self._lastProgress) < SYNC_PROGRESS_REPORT_DELTA:
+                return False
+        self._lastStep = step
+        self._lastProgress = progress
+        self._lastReport = now
+        return True
+
+
 class SynchronizationTaskResult:
     def __init__(self, force_next_sync=None, force_exhaustive=False):
         self.ForceNextSync = force_next_sync
         self.ForceExhaustive = force_exhaustive
+        # These feed SyncIntervalPolicy
+        self.ActivitiesSynchronized = 0
+        self.Triggered = False
 
     def ForceScheduleNextSyncOnOrBefore(self, next_sync):
         self.ForceNextSync = self.ForceNextSync if self.ForceNextSync and self.ForceNextSync < next_sync else next_sync
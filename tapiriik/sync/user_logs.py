@@ -0,0 +1,188 @@
+from tapiriik.database import cachedb
+from tapiriik.settings import USER_SYNC_LOGS, USER_SYNC_LOG_RETENTION_DAYS, USER_SYNC_LOG_SEGMENT_INTERVAL
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import atexit
+import copy
+import fcntl
+import glob
+import logging
+import os
+import queue
+import socket
+import threading
+import zlib
+
+logger = logging.getLogger("tapiriik.sync.logs")
+
+class UserSyncLog:
+    """ One sync's worth of log for a user - written out as compressed segments every USER_SYNC_LOG_SEGMENT_INTERVAL while it's open, and once more when closed """
+    def __init__(self, user_id):
+        self.UserID = user_id
+        self.LogID = ObjectId()
+        self.StartTime = datetime.utcnow()
+        UserSyncLogSink._put(("open", self, None))
+
+    def Write(self, text):
+        UserSyncLogSink._put(("write", self, text))
+
+    def Close(self):
+        UserSyncLogSink._put(("close", self, None))
+
+
+class UserSyncLogHandler(logging.Handler):
+    # Hands records off to the sink's thread, which does the formatting, compression and I/O
+    def __init__(self, log, level=logging.NOTSET):
+        super().__init__(level)
+        self._log = log
+
+    def emit(self, record):
+        try:
+            # Same as QueueHandler - merge the arguments now, while they're still what they were
+            record = copy.copy(record)
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.msg = record.getMessage()
+            record.args = None
+            record.exc_info = None
+            self._log.Write((self, record))
+        except Exception:
+            self.handleError(record)
+
+
+class UserSyncLogSink:
+    """ Writes user sync logs from a background thread.
+        Rather than a rotating set of files per user, each sync's log is compressed a segment at a time and appended to a file shared by every worker on the host (one per day),
+        with an entry in cachedb.sync_logs saying where to find it - which carries a copy of the segment too, so the logs can be read from any host.
+    """
+    _queue = queue.Queue()
+    _thread = None
+    _threadPid = None
+    _threadLock = threading.Lock()
+    _segmentFile = None
+    _segmentFilePath = None
+
+    def _put(op):
+        with UserSyncLogSink._threadLock:
+            # (a forked process doesn't get the thread, only our record of it)
+            if UserSyncLogSink._thread is None or UserSyncLogSink._threadPid != os.getpid():
+                UserSyncLogSink._queue = queue.Queue()
+                UserSyncLogSink._segmentFile = UserSyncLogSink._segmentFilePath = None
+                UserSyncLogSink._threadPid = os.getpid()
+                UserSyncLogSink._thread = threading.Thread(target=UserSyncLogSink._run, name="user-sync-logs", daemon=True)
+                UserSyncLogSink._thread.start()
+                atexit.register(UserSyncLogSink.Flush)
+        UserSyncLogSink._queue.put(op)
+
+    def Flush():
+        """ Blocks until everything handed off so far is written """
+        if UserSyncLogSink._thread is not None:
+            UserSyncLogSink._queue.join()
+
+    def EnsureIndexes():
+        cachedb.sync_logs.ensure_index([("UserID", 1), ("Timestamp", -1), ("Part", 1)])
+        cachedb.sync_logs.ensure_index("Timestamp", expireAfterSeconds=int(timedelta(days=USER_SYNC_LOG_RETENTION_DAYS).total_seconds()))
+
+    def Read(user_id, count=5):
+        """ Returns the user's last <count> sync logs, most recent first - including those still underway, as far as they've been written out """
+        logs = []
+        logsByID = {}
+        for segment in cachedb.sync_logs.find({"UserID": user_id}).sort([("Timestamp", -1), ("Part", 1)]):
+            if segment["LogID"] not in logsByID:
+                if len(logs) == count:
+                    break
+                logsByID[segment["LogID"]] = {"Timestamp": segment["Timestamp"], "Host": segment["Host"], "Log": ""}
+                logs.append(logsByID[segment["LogID"]])
+            try:
+                logsByID[segment["LogID"]]["Log"] += zlib.decompress(segment["Data"]).decode("utf-8")
+            except zlib.error:
+                logger.warning("Corrupt sync log segment %s" % segment["_id"])
+        return logs
+
+    def _run():
+        openLogs = set()
+        while True:
+            try:
+                op, log, data = UserSyncLogSink._queue.get(timeout=USER_SYNC_LOG_SEGMENT_INTERVAL)
+            except queue.Empty:
+                # Nothing's been logged for a while - but there may still be something waiting to be written out
+                UserSyncLogSink._writeDueSegments(openLogs)
+                continue
+            try:
+                if op == "open":
+                    log._part = 0
+                    UserSyncLogSink._startSegment(log)
+                    openLogs.add(log)
+                elif op == "write":
+                    if isinstance(data, tuple):
+                        handler, record = data
+                        data = handler.format(record) + "\n"
+                    if log._segmentStart is None:
+                        log._segmentStart = datetime.utcnow()
+                    log._segment.append(log._compressor.compress(data.encode("utf-8")))
+                elif op == "close":
+                    openLogs.discard(log)
+                    if log._segmentStart is not None or log._part == 0:
+                        UserSyncLogSink._writeSegment(log)
+                    del log._segment
+                    del log._compressor
+                UserSyncLogSink._writeDueSegments(openLogs)
+            except Exception:
+                logger.exception("Failed writing sync log for %s" % log.UserID)
+            finally:
+                UserSyncLogSink._queue.task_done()
+
+    def _startSegment(log):
+        # Each segment is a complete zlib stream of its own, so they can be read back independently
+        log._compressor = zlib.compressobj()
+        log._segment = []
+        log._segmentStart = None
+
+    def _writeDueSegments(openLogs):
+        segmentDue = datetime.utcnow() - timedelta(seconds=USER_SYNC_LOG_SEGMENT_INTERVAL)
+        for log in openLogs:
+            if log._segmentStart is not None and log._segmentStart <= segmentDue:
+                try:
+                    UserSyncLogSink._writeSegment(log)
+                except Exception:
+                    logger.exception("Failed writing sync log for %s" % log.UserID)
+
+    def _writeSegment(log):
+        log._segment.append(log._compressor.flush())
+        segment = b"".join(log._segment)
+        part = log._part
+        log._part += 1
+        UserSyncLogSink._startSegment(log)
+        path, offset = UserSyncLogSink._appendSegment(segment)
+        cachedb.sync_logs.insert({"UserID": log.UserID, "LogID": log.LogID, "Part": part, "Timestamp": log.StartTime, "Host": socket.gethostname(), "Path": os.path.abspath(path), "Offset": offset, "Length": len(segment), "Data": Binary(segment)})
+
+    def _appendSegment(segment):
+        path = USER_SYNC_LOGS + "sync-%s-%s.logz" % (socket.gethostname(), datetime.utcnow().strftime("%Y%m%d"))
+        if path != UserSyncLogSink._segmentFilePath:
+            if UserSyncLogSink._segmentFile is not None:
+                os.close(UserSyncLogSink._segmentFile)
+            UserSyncLogSink._segmentFile = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            UserSyncLogSink._segmentFilePath = path
+            UserSyncLogSink._removeExpiredSegmentFiles()
+        # Every worker process on the host appends to this file - O_APPEND keeps the writes from overwriting each other,
+        # and the lock keeps another's from landing between finding the end of the file and writing there (so the offset's right)
+        fcntl.flock(UserSyncLogSink._segmentFile, fcntl.LOCK_EX)
+        try:
+            offset = os.lseek(UserSyncLogSink._segmentFile, 0, os.SEEK_END)
+            written = 0
+            while written < len(segment):
+                written += os.write(UserSyncLogSink._segmentFile, segment[written:])
+        finally:
+            fcntl.flock(UserSyncLogSink._segmentFile, fcntl.LOCK_UN)
+        return path, offset
+
+    def _removeExpiredSegmentFiles():
+        # The index entries expire on their own (see EnsureIndexes), these don't
+        expiry = datetime.utcnow() - timedelta(days=USER_SYNC_LOG_RETENTION_DAYS + 1)
+        for path in glob.glob(USER_SYNC_LOGS + "sync-%s-*.logz" % socket.gethostname()):
+            try:
+                if datetime.utcfromtimestamp(os.path.getmtime(path)) < expiry:
+                    os.remove(path)
+            except OSError:
+                pass # Another worker got to it first
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from pymongo import InsertOne, UpdateOne, UpdateMany
+from pymongo.errors import BulkWriteError
+import collections
+
+class SyncWriteBuffer:
+    """ Holds on to writes that nothing in the sync reads back, and sends them along as unordered bulk writes once enough pile up (or they get old enough). """
+
+    def __init__(self, maxOperations, maxAge):
+        self._maxOperations = maxOperations
+        self._maxAge = timedelta(seconds=maxAge)
+        self._reset()
+
+    def _reset(self):
+        self._pending = collections.OrderedDict() # collection full name -> (collection, [(operation, error handler)])
+        self._count = 0
+        self._oldest = None
+
+    def __len__(self):
+        return self._count
+
+    def Insert(self, collection, document):
+        self._enqueue(collection, InsertOne(document), None)
+
+    def Update(self, collection, spec, document, upsert=False, multi=False, error_handler=None):
+        """ error_handler is called with the error code of a failed write, and returns True if it dealt with it - otherwise the error is raised on flush """
+        self._enqueue(collection, (UpdateMany if multi else UpdateOne)(spec, document, upsert=upsert), error_handler)
+
+    def _enqueue(self, collection, operation, error_handler):
+        if collection.full_name not in self._pending:
+            self._pending[collection.full_name] = (collection, [])
+        self._pending[collection.full_name][1].append((operation, error_handler))
+        self._count += 1
+        if self._oldest is None:
+            self._oldest = datetime.utcnow()
+        if self._count >= self._maxOperations or datetime.utcnow() - self._oldest >= self._maxAge:
+            self.Flush()
+
+    def Flush(self):
+        """ Writes out everything buffered. A collection's operations are only dropped once its bulk write has gone through - if it fails outright (AutoReconnect, etc.), it and everything after it stay buffered for the next flush, and the error is raised """
+        unhandledError = None
+        for name in list(self._pending.keys()):
+            collection, operations = self._pending[name]
+            try:
+                collection.bulk_write([operation for operation, error_handler in operations], ordered=False)
+            except BulkWriteError as e:
+                # Unordered, so everything else went through - just deal with the failures
+                for writeError in e.details["writeErrors"]:
+                    error_handler = operations[writeError["index"]][1]
+                    if not error_handler or not error_handler(writeError["code"]):
+                        unhandledError = e
+            del self._pending[name]
+            self._count -= len(operations)
+        self._oldest = None
+        if unhandledError:
+            raise unhandledError
@@ -0,0 +1,69 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.services.auto_pause import AutoPauseCalculator
+from tapiriik.services.interchange import Waypoint, WaypointType, Location
+import tapiriik.services.auto_pause
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import random
+
+
+class AutoPauseTests(TapiriikTestCase):
+
+    def _waypoints(self, points):
+        # points are (seconds, (lat, lon) or None)
+        start = datetime(2015, 6, 1, 12, 0, 0)
+        return [Waypoint(timestamp=start + timedelta(seconds=t), location=Location(loc[0], loc[1], None) if loc else None) for t, loc in points]
+
+    def _calculate(self, waypoints, target_duration):
+        try:
+            return list(AutoPauseCalculator.calculate(waypoints, target_duration))
+        except ValueError:
+            return ValueError
+
+    def _assertImplementationsAgree(self, waypoints, target_duration):
+        if tapiriik.services.auto_pause.numpy is None:
+            self.skipTest("NumPy not installed")
+        vectorized = self._calculate(waypoints, target_duration)
+        with patch("tapiriik.services.auto_pause.numpy", None):
+            iterative = self._calculate(waypoints, target_duration)
+        self.assertEqual(vectorized, iterative)
+        return vectorized
+
+    def test_time_gap(self):
+        # Long gaps (the user paused their device) are paused over, longest first - though only those longer than the last one it needed to count
+        times = list(range(5)) + list(range(64, 69)) + list(range(98, 103))
+        points = [(t, (0, idx * 0.001)) for idx, t in enumerate(times)]
+        expected = [WaypointType.Regular] * 4 + [WaypointType.Pause, WaypointType.Resume] + [WaypointType.Regular] * 9
+        for target in [10, timedelta(seconds=10)]:
+            self.assertEqual(self._calculate(self._waypoints(points), target), expected)
+            self.assertEqual(self._assertImplementationsAgree(self._waypoints(points), target), expected)
+
+    def test_stationary(self):
+        # No gaps to speak of, so it's the least movement that's paused over (exactly representable, so the comparisons are exact)
+        step, small = 2 ** -10, 2 ** -14
+        longitudes = [0, step, 2 * step, 2 * step + small, 2 * step + 3 * small, 3 * step + 3 * small, 4 * step + 3 * small]
+        points = [(idx, (0, lon)) for idx, lon in enumerate(longitudes)]
+        expected = [WaypointType.Regular, WaypointType.Regular, WaypointType.Pause, WaypointType.Resume, WaypointType.Regular, WaypointType.Regular, WaypointType.Regular]
+        self.assertEqual(self._assertImplementationsAgree(self._waypoints(points), 4.5), expected)
+
+        # Not moving at all isn't something it can work with
+        points = [(0, (0, 0)), (1, (0, step)), (2, (0, step)), (3, (0, 2 * step))]
+        self.assertEqual(self._assertImplementationsAgree(self._waypoints(points), 2.5), ValueError)
+
+    def test_target_met(self):
+        points = [(t, (0, t * 0.001)) for t in range(10)]
+        self.assertEqual(self._assertImplementationsAgree(self._waypoints(points), 9), [WaypointType.Regular] * 10)
+
+    def test_implementations_equivalent(self):
+        # Sampling intervals and locations from a small set of values, so there are plenty of ties in both
+        rng = random.Random(42)
+        for x in range(300):
+            t = 0
+            points = []
+            for idx in range(rng.randint(2, 40)):
+                points.append((t, (rng.randint(0, 3) * 0.001, rng.randint(0, 3) * 0.001) if rng.random() > 0.1 else None))
+                t += rng.choice([0.5, 1, 1, 1, 2, 2, 5, 30, 90])
+            elapsed = points[-1][0]
+            self._assertImplementationsAgree(self._waypoints(points), elapsed * rng.choice([0.2, 0.5, 0.8, 0.95, 1]))
@@ -1,9 +1,18 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.services import Service
-from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.interchange import Activity, ActivityType, Waypoint, WaypointType, Location, Lap, WaypointStore
+from tapiriik.services.gpx import GPXIO
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.pwx import PWXIO
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import dateutil.tz
+import calendar
+import copy
+import math
+import pytz
 
 
 class InterchangeTests(TapiriikTestCase):
@@ -63,3 +72,87 @@ class InterchangeTests(TapiriikTestCase):
 
         # Normal w/ Other + None
         self.assertEqual(ActivityType.PickMostSpecific([ActivityType.Other, ActivityType.Cycling, None, ActivityType.MountainBiking]), ActivityType.MountainBiking)
+
+
+class WaypointStoreTests(TapiriikTestCase):
+
+    def _waypoints(self, count=5, tz=None):
+        start = datetime(2015, 6, 1, 12, 0, 0)
+        start = tz.localize(start) if hasattr(tz, "localize") else start.replace(tzinfo=tz)
+        return [Waypoint(timestamp=start + timedelta(seconds=10 * x), location=Location(45 + x / 1000, -75.5, 100.0 + x), hr=120 + x, cadence=80.5, distance=10.0 * x) for x in range(count)]
+
+    def test_compacted_dumps(self):
+        ''' the writers must produce exactly the same files from compacted waypoints as from plain lists '''
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsTemp = svcA.SupportsPower = svcA.SupportsCalories = True
+        act = TestTools.create_random_activity(svcA, tz=True)
+        for writer in [GPXIO, TCXIO, PWXIO]:
+            plain = copy.deepcopy(act)
+            compacted = copy.deepcopy(act)
+            compacted.CompactWaypoints()
+            self.assertEqual(writer.Dump(compacted), writer.Dump(plain))
+
+    def test_column_mixed_tz(self):
+        waypoints = self._waypoints(2) + self._waypoints(2, tz=pytz.timezone("America/Denver")) + self._waypoints(2, tz=timezone(timedelta(hours=5, minutes=30))) + self._waypoints(2, tz=dateutil.tz.tzoffset(None, -3600)) + [Waypoint()]
+        expected = [calendar.timegm(wp.Timestamp.utctimetuple()) if wp.Timestamp.tzinfo else calendar.timegm(wp.Timestamp.timetuple()) for wp in waypoints[:-1]]
+        store = WaypointStore(list(waypoints))
+        store.Compact()
+        column = store.Column("Timestamp")
+        self.assertEqual(list(column[:-1]), expected)
+        self.assertTrue(math.isnan(column[-1]))
+        # The same tzinfo objects come back out
+        for wp, original in zip(store, waypoints):
+            self.assertEqual(wp.Timestamp, original.Timestamp)
+            self.assertTrue(wp.Timestamp is None or wp.Timestamp.tzinfo is original.Timestamp.tzinfo)
+
+        # ...and uncompacted waypoints are read the same way
+        store.append(self._waypoints(1, tz=pytz.utc)[0])
+        self.assertEqual(store.Column("Timestamp")[-1], calendar.timegm(datetime(2015, 6, 1, 12, 0, 0).timetuple()))
+
+    def test_set_unfit(self):
+        store = WaypointStore(self._waypoints())
+        store.Compact()
+        store[1].HR = Decimal("150.5")
+        store[2].Power = 2 ** 60
+        store[3].Location = Location(Decimal("45.1"), -75.5, None)
+        self.assertEqual(store[1].HR, Decimal("150.5"))
+        self.assertEqual(store[2].Power, 2 ** 60)
+        self.assertEqual(store[3].Location.Latitude, Decimal("45.1"))
+        self.assertEqual(store[3].Location.Altitude, None)
+        # Nothing else about those rows changes
+        for row in [1, 2, 3]:
+            self.assertEqual(store[row].Timestamp, datetime(2015, 6, 1, 12, 0, 10 * row))
+            self.assertEqual(store[row].Distance, 10.0 * row)
+        self.assertEqual(type(store[0].HR), int)
+        self.assertEqual(list(store.Column("HR")), [120, 150.5, 122, 123, 124])
+        self.assertEqual(list(store.Column("Latitude"))[3], 45.1)
+
+    def test_mutation_after_compaction(self):
+        waypoints = self._waypoints()
+        store = WaypointStore(copy.deepcopy(waypoints))
+        store.Compact()
+        view = store[2]
+        location = view.Location
+        self.assertEqual(store, waypoints)
+
+        early = Waypoint(timestamp=datetime(2015, 6, 1, 11, 0, 0), ptType=WaypointType.Start)
+        store.insert(0, early)
+        del store[1]
+        store.append(Waypoint(timestamp=datetime(2015, 6, 1, 11, 30, 0)))
+        store.sort(key=lambda wp: wp.Timestamp)
+        self.assertEqual([wp.Timestamp for wp in store], [early.Timestamp, datetime(2015, 6, 1, 11, 30, 0)] + [wp.Timestamp for wp in waypoints[1:]])
+
+        # Views from before still read, and write, the same waypoint
+        self.assertEqual(view.Timestamp, waypoints[2].Timestamp)
+        self.assertEqual(location.Altitude, 102.0)
+        view.HR = 42
+        location.Altitude = 42.0
+        self.assertEqual(store[3].HR, 42)
+        self.assertEqual(store[3].Location.Altitude, 42.0)
+        self.assertEqual(store.Column("HR")[3], 42)
+
+        # A lap can be handed a compacted store, or a plain list, either way
+        lap = Lap(waypointList=store)
+        self.assertTrue(lap.Waypoints is store)
+        lap.Waypoints = list(store)
+        self.assertEqual(lap.Waypoints, store)
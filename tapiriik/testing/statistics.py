@@ -1,6 +1,11 @@
-from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit
+from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit, Activity, Lap, Waypoint, WaypointType, Location
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+import tapiriik.services.statistic_calculator
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
 
 
 class StatisticTests(TapiriikTestCase):
@@ -181,3 +186,107 @@ class StatisticTests(TapiriikTestCase):
         self.assertEqual(stat1.Value, 2)
         self.assertEqual(stat1.Max, 2)
         self.assertEqual(stat1.Gain, 3)
+
+
+class StatisticCalculatorTests(TapiriikTestCase):
+    # Along the equator, a thousandth of a degree of longitude is this many meters (per ActivityStatisticCalculator's approximation)
+    _lonStep = 111.31934
+
+    def _withAndWithoutNumPy(self, check):
+        ''' the NumPy and pure-Python implementations have to give the same results '''
+        if tapiriik.services.statistic_calculator.numpy is not None:
+            check()
+        with patch("tapiriik.services.statistic_calculator.numpy", None):
+            check()
+
+    def _activity(self, points, compact=False):
+        # points are (seconds, longitude or None, type, HR, speed)
+        start = datetime(2015, 6, 1, 12, 0, 0)
+        waypoints = [Waypoint(timestamp=start + timedelta(seconds=t), ptType=ptType, location=Location(0, lon, 100) if lon is not None else None, hr=hr, speed=speed) for t, lon, ptType, hr, speed in points]
+        half = len(waypoints) // 2
+        act = Activity(startTime=waypoints[0].Timestamp, endTime=waypoints[-1].Timestamp)
+        act.Laps = [Lap(waypointList=waypoints[:half]), Lap(waypointList=waypoints[half:])]
+        if compact:
+            act.CompactWaypoints()
+        return act
+
+    def _pausedActivity(self, compact=False):
+        return self._activity([
+            (0, 0, WaypointType.Start, 100, None),
+            (10, 0.001, WaypointType.Regular, 110, None),
+            (20, 0.001, WaypointType.Regular, 120, None), # Stationary
+            (30, 0.002, WaypointType.Pause, 130, None),
+            (100, 0.003, WaypointType.Resume, 140, None), # Time spent paused doesn't count
+            (110, 0.004, WaypointType.Regular, 150, None),
+            (200, 0.005, WaypointType.Regular, None, None), # Nor does a gap this long
+            (210, 0.006, WaypointType.Regular, 160, None),
+            (220, 0.007, WaypointType.End, None, None)
+        ], compact=compact)
+
+    def test_calculate_paused(self):
+        for compact in [False, True]:
+            act = self._pausedActivity(compact)
+            def check():
+                self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act), 2 * self._lonStep, places=3)
+                self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act), timedelta(seconds=60))
+                self.assertEqual(ActivityStatisticCalculator.CalculateMovingTime(act), timedelta(seconds=50))
+                self.assertEqual(ActivityStatisticCalculator.CalculateAverageMaxHR(act), (130, 160))
+                self.assertEqual(type(ActivityStatisticCalculator.CalculateAverageMaxHR(act)[1]), int)
+            self._withAndWithoutNumPy(check)
+
+    def test_calculate_range(self):
+        act = self._pausedActivity()
+        waypoints = act.GetFlatWaypoints()
+        def check():
+            self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act, waypoints[0], waypoints[2]), self._lonStep, places=3)
+            self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act, waypoints[5], waypoints[7]), timedelta(seconds=10))
+            self.assertEqual(ActivityStatisticCalculator.CalculateAverageMaxHR(act, waypoints[6], waypoints[6]), (None, None))
+        self._withAndWithoutNumPy(check)
+
+    def test_calculate_moving_by_speed(self):
+        # Without locations, moving time goes by the waypoints' speeds - and assumes moving when there isn't one
+        act = self._activity([
+            (0, None, WaypointType.Start, None, None),
+            (10, None, WaypointType.Regular, None, 2),
+            (20, None, WaypointType.Regular, None, 0.1),
+            (30, None, WaypointType.End, None, None)
+        ])
+        def check():
+            self.assertEqual(ActivityStatisticCalculator.CalculateDistance(act), 0)
+            self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act), timedelta(seconds=30))
+            self.assertEqual(ActivityStatisticCalculator.CalculateMovingTime(act), timedelta(seconds=20))
+            self.assertEqual(ActivityStatisticCalculator.CalculateAverageMaxHR(act), (None, None))
+        self._withAndWithoutNumPy(check)
+
+    def test_calculate_statistics(self):
+        act = self._pausedActivity()
+        def check():
+            stats = ActivityStatisticCalculator.CalculateStatistics(act)
+            self.assertAlmostEqual(stats.Distance.Value, 2 * self._lonStep, places=3)
+            self.assertEqual(stats.TimerTime.Value, 60)
+            self.assertEqual(stats.MovingTime.Value, 50)
+            self.assertEqual(stats.HR.Average, 130)
+            self.assertEqual(stats.HR.Max, 160)
+        self._withAndWithoutNumPy(check)
+
+    def test_calculate_timer_time_too_few(self):
+        act = self._activity([(0, 0, WaypointType.Start, None, None), (10, 0.001, WaypointType.End, None, None)])
+        def check():
+            self.assertRaises(ValueError, ActivityStatisticCalculator.CalculateTimerTime, act)
+        self._withAndWithoutNumPy(check)
+
+    def test_calculate_random_equivalent(self):
+        if tapiriik.services.statistic_calculator.numpy is None:
+            self.skipTest("NumPy not installed")
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = True
+        for x in range(10):
+            act = TestTools.create_random_activity(svcA, tz=True)
+            numpyStats = ActivityStatisticCalculator.CalculateStatistics(act)
+            with patch("tapiriik.services.statistic_calculator.numpy", None):
+                pythonStats = ActivityStatisticCalculator.CalculateStatistics(act)
+            self.assertAlmostEqual(numpyStats.Distance.Value, pythonStats.Distance.Value, delta=pythonStats.Distance.Value * 1e-12)
+            self.assertEqual(numpyStats.TimerTime.Value, pythonStats.TimerTime.Value)
+            self.assertEqual(numpyStats.MovingTime.Value, pythonStats.MovingTime.Value)
+            self.assertAlmostEqual(numpyStats.HR.Average, pythonStats.HR.Average)
+            self.assertEqual(numpyStats.HR.Max, pythonStats.HR.Max)
@@ -0,0 +1,47 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.services.stream_sampling import StreamSampler
+
+
+class StreamSamplingTests(TapiriikTestCase):
+
+    def _sample(self, streams):
+        samples = []
+        StreamSampler.SampleWithCallback(lambda offset, **values: samples.append((offset, values)), streams)
+        return samples
+
+    def test_interleaved(self):
+        streams = {
+            "hr": [(0, 100), (2, 110), (5, 120)],
+            "lat": [(1, 45.0), (2, 45.1), (3, 45.2)]
+        }
+        expected = [
+            (0, {"hr": 100}), # Streams only show up once they've started
+            (1, {"hr": 100, "lat": 45.0}),
+            (2, {"hr": 110, "lat": 45.1}), # Simultaneous samples make one waypoint
+            (3, {"hr": 110, "lat": 45.2}),
+            (5, {"hr": 120, "lat": 45.2}) # The last value holds after a stream ends
+        ]
+        self.assertEqual(self._sample(streams), expected)
+        # Generators are read in step, and come out the same
+        self.assertEqual(self._sample(dict((stream, (sample for sample in samples)) for stream, samples in streams.items())), expected)
+
+    def test_same_offset(self):
+        # Several samples at the same offset in a stream each get their own waypoint, in order
+        streams = {
+            "hr": [(0, 1), (0, 2), (1, 3)],
+            "cadence": [(0, 10), (1, 11), (1, 12)]
+        }
+        expected = [
+            (0, {"hr": 1, "cadence": 10}),
+            (0, {"hr": 2, "cadence": 10}),
+            (1, {"hr": 3, "cadence": 11}),
+            (1, {"hr": 3, "cadence": 12})
+        ]
+        self.assertEqual(self._sample(streams), expected)
+        self.assertEqual(self._sample(dict((stream, iter(samples)) for stream, samples in streams.items())), expected)
+
+    def test_empty(self):
+        self.assertEqual(self._sample({}), [])
+        self.assertEqual(self._sample({"hr": [], "lat": (x for x in [])}), [])
+        self.assertEqual(self._sample({"hr": [], "lat": [(0.5, None), (1.5, 45.0)]}), [(0.5, {"lat": None}), (1.5, {"lat": 45.0})])
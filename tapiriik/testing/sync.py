@@ -1,15 +1,25 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.sync import SynchronizationTask
+from tapiriik.sync.write_buffer import SyncWriteBuffer
+from tapiriik.sync.schedule import RedisSyncSchedule, SyncSlotHistogram
+from tapiriik.sync.interval import SyncIntervalPolicy
+from tapiriik.sync.sync import SynchronizationTaskResult
 from tapiriik.sync.activity_record import ActivityRecord
 from tapiriik.services import UserException, UserExceptionType
 from tapiriik.services.api import APIExcludeActivity
 from tapiriik.services.interchange import Activity, ActivityType
 from tapiriik.auth import User
+from tapiriik.database import db
+from pymongo.errors import BulkWriteError, AutoReconnect
+from bson.objectid import ObjectId
 
 from datetime import datetime, timedelta, tzinfo
+from unittest.mock import patch
 import pytz
 import copy
+import calendar
+import collections
 
 
 class UTC(tzinfo):
@@ -604,3 +614,231 @@ class SyncTests(TapiriikTestCase):
         eligible = s._determineEligibleRecipientServices(act, recipientServices)
         self.assertTrue(recA in eligible)
         self.assertTrue(recB in eligible)
+
+
+class MockBulkCollection:
+    def __init__(self, name, failures=None):
+        self.full_name = name
+        self.failures = failures if failures else [] # Raised by successive bulk_write calls (None to succeed)
+        self.written = []
+
+    def bulk_write(self, operations, ordered=True):
+        failure = self.failures.pop(0) if self.failures else None
+        if failure:
+            raise failure
+        self.written += operations
+
+
+class SyncWriteBufferTests(TapiriikTestCase):
+
+    def test_flush_by_size(self):
+        coll = MockBulkCollection("test.a")
+        buf = SyncWriteBuffer(3, 60)
+        buf.Insert(coll, {"a": 1})
+        buf.Insert(coll, {"a": 2})
+        self.assertEqual(len(coll.written), 0)
+        buf.Insert(coll, {"a": 3})
+        self.assertEqual(len(coll.written), 3)
+        self.assertEqual(len(buf), 0)
+
+    def test_error_handler_routing(self):
+        handled_codes = []
+        def handler(code):
+            handled_codes.append(code)
+            return code == 11000
+        coll = MockBulkCollection("test.a", failures=[BulkWriteError({"writeErrors": [{"index": 1, "code": 11000}]})])
+        buf = SyncWriteBuffer(100, 60)
+        buf.Update(coll, {"a": 1}, {"$set": {"b": 1}})
+        buf.Update(coll, {"a": 2}, {"$set": {"b": 2}}, upsert=True, error_handler=handler)
+        buf.Flush() # Handled, so nothing's raised
+        self.assertEqual(handled_codes, [11000])
+        self.assertEqual(len(buf), 0)
+
+        # The same failure on an operation without a handler (or whose handler declines it) is raised - but only once the other collections are written
+        collA = MockBulkCollection("test.a", failures=[BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}, {"index": 1, "code": 2}]})])
+        collB = MockBulkCollection("test.b")
+        buf.Update(collA, {"a": 1}, {"$set": {"b": 1}}, error_handler=handler)
+        buf.Update(collA, {"a": 2}, {"$set": {"b": 2}}, error_handler=handler)
+        buf.Insert(collB, {"a": 1})
+        self.assertRaises(BulkWriteError, buf.Flush)
+        self.assertEqual(handled_codes, [11000, 11000, 2])
+        self.assertEqual(len(collB.written), 1)
+        # The write itself went through (it's unordered), so it's not retried
+        self.assertEqual(len(buf), 0)
+
+    def test_flush_partial_failure(self):
+        collA = MockBulkCollection("test.a")
+        collB = MockBulkCollection("test.b", failures=[AutoReconnect()])
+        collC = MockBulkCollection("test.c")
+        buf = SyncWriteBuffer(100, 60)
+        buf.Insert(collA, {"a": 1})
+        buf.Insert(collB, {"b": 1})
+        buf.Insert(collB, {"b": 2})
+        buf.Insert(collC, {"c": 1})
+        self.assertRaises(AutoReconnect, buf.Flush)
+        # What was written is gone, the rest is kept for next time
+        self.assertEqual(len(collA.written), 1)
+        self.assertEqual(len(collC.written), 0)
+        self.assertEqual(len(buf), 3)
+
+        buf.Flush()
+        self.assertEqual(len(collA.written), 1)
+        self.assertEqual(len(collB.written), 2)
+        self.assertEqual(len(collC.written), 1)
+        self.assertEqual(len(buf), 0)
+
+
+class RedisSyncScheduleTests(TapiriikTestCase):
+
+    def _requireRedis(self):
+        import tapiriik.sync.schedule
+        if tapiriik.sync.schedule.redis is None:
+            self.skipTest("No REDIS_HOST")
+        return tapiriik.sync.schedule.redis
+
+    def test_disabled_fallback(self):
+        with patch("tapiriik.sync.schedule.redis", None), patch("tapiriik.sync.schedule.SYNC_SCHEDULE_REDIS", True):
+            self.assertFalse(RedisSyncSchedule.Enabled())
+            RedisSyncSchedule.Schedule([ObjectId()], datetime.utcnow()) # Nothing to do, but mustn't fail
+            self.assertEqual(RedisSyncSchedule.Reconcile(), 0)
+
+    def test_pop_due(self):
+        redis = self._requireRedis()
+        with patch("tapiriik.sync.schedule.SYNC_SCHEDULE_REDIS", True), patch.object(RedisSyncSchedule, "Key", "sync-schedule-test"):
+            redis.delete(RedisSyncSchedule.Key)
+            now = datetime.utcnow()
+            oldest, older, old, future = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+            RedisSyncSchedule.Schedule([old], now - timedelta(minutes=1))
+            RedisSyncSchedule.Schedule([oldest], now - timedelta(hours=1))
+            RedisSyncSchedule.Schedule([older], now - timedelta(minutes=10))
+            RedisSyncSchedule.Schedule([future], now + timedelta(minutes=10))
+
+            # Most overdue first, and they're gone once popped
+            self.assertEqual(RedisSyncSchedule.PopDue(now, 2), [oldest, older])
+            self.assertEqual(RedisSyncSchedule.PopDue(now, 2), [old])
+            self.assertEqual(RedisSyncSchedule.PopDue(now, 2), [])
+            self.assertEqual(RedisSyncSchedule.PopDue(now + timedelta(hours=1), 2), [future])
+
+            # None takes them out altogether
+            RedisSyncSchedule.Schedule([old], now - timedelta(minutes=1))
+            RedisSyncSchedule.Schedule([old], None)
+            self.assertEqual(RedisSyncSchedule.PopDue(now, 2), [])
+            redis.delete(RedisSyncSchedule.Key)
+
+    def test_reconcile(self):
+        redis = self._requireRedis()
+        with patch("tapiriik.sync.schedule.SYNC_SCHEDULE_REDIS", True), patch.object(RedisSyncSchedule, "Key", "sync-schedule-test"):
+            redis.delete(RedisSyncSchedule.Key)
+            now = datetime.utcnow().replace(microsecond=0)
+            scheduled = [ObjectId() for x in range(5)]
+            unscheduled = ObjectId()
+            db.users.insert([{"_id": x, "NextSynchronization": now - timedelta(minutes=idx)} for idx, x in enumerate(scheduled)])
+            db.users.insert({"_id": unscheduled})
+            try:
+                # Pretend the set fell out of step - one entry missing, another at the wrong time
+                RedisSyncSchedule.Schedule([scheduled[0]], now + timedelta(days=1))
+                self.assertEqual(RedisSyncSchedule.Reconcile(batch_size=2), db.users.find({"NextSynchronization": {"$ne": None}}).count())
+                self.assertEqual(RedisSyncSchedule.PopDue(now, 10), list(reversed(scheduled)))
+            finally:
+                db.users.remove({"_id": {"$in": scheduled + [unscheduled]}})
+                redis.delete(RedisSyncSchedule.Key)
+
+
+class SyncIntervalPolicyTests(TapiriikTestCase):
+
+    def test_interval_standard(self):
+        self.assertEqual(SyncIntervalPolicy.Interval({}), SyncIntervalPolicy.StandardInterval)
+        user = {"SyncActivityRate": 3, "LastActivitySynchronization": datetime.utcnow() - timedelta(days=60)}
+        with patch("tapiriik.sync.interval.SYNC_ADAPTIVE_INTERVAL", False):
+            self.assertEqual(SyncIntervalPolicy.Interval(user), SyncIntervalPolicy.StandardInterval)
+
+    def test_interval_clamped(self):
+        now = datetime.utcnow()
+        # Busy users get synced more often, but no more than so often
+        self.assertEqual(SyncIntervalPolicy.Interval({"SyncActivityRate": 1, "LastActivitySynchronization": now}), SyncIntervalPolicy.StandardInterval / 2)
+        self.assertEqual(SyncIntervalPolicy.Interval({"SyncActivityRate": 100, "LastActivitySynchronization": now}), SyncIntervalPolicy.MinimumInterval)
+        # Quiet accounts less often, but not never
+        self.assertEqual(SyncIntervalPolicy.Interval({"LastActivitySynchronization": now - SyncIntervalPolicy.IdlePeriod / 2}), SyncIntervalPolicy.StandardInterval)
+        self.assertAlmostEqual(SyncIntervalPolicy.Interval({"LastActivitySynchronization": now - SyncIntervalPolicy.IdlePeriod * 3}).total_seconds(), (SyncIntervalPolicy.StandardInterval * 3).total_seconds(), places=0)
+        self.assertEqual(SyncIntervalPolicy.Interval({"LastActivitySynchronization": now - timedelta(days=365)}), SyncIntervalPolicy.MaximumInterval)
+        self.assertEqual(SyncIntervalPolicy.Interval({"SyncTriggerRate": 1, "LastActivitySynchronization": now - SyncIntervalPolicy.IdlePeriod * 10}), SyncIntervalPolicy.MaximumInterval)
+
+    def test_history_update(self):
+        weight = SyncIntervalPolicy.HistoryWeight
+        result = SynchronizationTaskResult()
+        # The clock starts on the first sync, whatever it turned up
+        update = SyncIntervalPolicy.HistoryUpdate({}, result)
+        self.assertEqual(update["SyncActivityRate"], 0)
+        self.assertEqual(update["SyncTriggerRate"], 0)
+        self.assertTrue("LastActivitySynchronization" in update)
+
+        lastActivity = datetime.utcnow() - timedelta(days=3)
+        user = {"SyncActivityRate": 1, "SyncTriggerRate": 0.5, "LastActivitySynchronization": lastActivity}
+        update = SyncIntervalPolicy.HistoryUpdate(user, result)
+        self.assertAlmostEqual(update["SyncActivityRate"], 1 - weight)
+        self.assertAlmostEqual(update["SyncTriggerRate"], 0.5 * (1 - weight))
+        self.assertFalse("LastActivitySynchronization" in update)
+
+        result.ActivitiesSynchronized = 2
+        result.Triggered = True
+        update = SyncIntervalPolicy.HistoryUpdate(user, result)
+        self.assertAlmostEqual(update["SyncActivityRate"], (1 - weight) + 2 * weight)
+        self.assertAlmostEqual(update["SyncTriggerRate"], 0.5 * (1 - weight) + weight)
+        self.assertTrue(update["LastActivitySynchronization"] > lastActivity)
+
+
+class SyncSlotHistogramTests(TapiriikTestCase):
+
+    def _clearSlots(self, redis):
+        keys = redis.keys(SyncSlotHistogram.KeyPrefix + "*")
+        if keys:
+            redis.delete(*keys)
+
+    def test_place_fallback(self):
+        target = datetime(2015, 6, 1, 12, 0, 0)
+        spread = timedelta(minutes=5)
+        with patch("tapiriik.sync.schedule.redis", None):
+            placed = SyncSlotHistogram.Place(target, spread, 50)
+            self.assertEqual(len(placed), 50)
+            for due in placed:
+                self.assertTrue(target - spread <= due <= target + spread)
+            self.assertEqual(SyncSlotHistogram.Place(target, timedelta(0)), [target])
+
+    def test_place_least_occupied(self):
+        import tapiriik.sync.schedule
+        redis = tapiriik.sync.schedule.redis
+        if redis is None:
+            self.skipTest("No REDIS_HOST")
+        slotSize = 60
+        with patch("tapiriik.sync.schedule.SYNC_SCHEDULE_SLOT_SIZE", slotSize), patch.object(SyncSlotHistogram, "KeyPrefix", "sync-slot-test:"):
+            self._clearSlots(redis)
+            # Mid-slot, so the spread covers 2 whole slots either side
+            target = datetime.utcnow().replace(second=30, microsecond=0) + timedelta(days=1)
+            targetSlot = calendar.timegm(target.utctimetuple()) // slotSize
+            slotOf = lambda due: calendar.timegm(due.utctimetuple()) // slotSize
+
+            # The nearest slot goes first, then the others in turn
+            self.assertEqual(slotOf(SyncSlotHistogram.Place(target, timedelta(minutes=2))[0]), targetSlot)
+            placed = SyncSlotHistogram.Place(target, timedelta(minutes=2), 9)
+            occupancy = collections.Counter(slotOf(due) for due in placed)
+            occupancy[targetSlot] += 1
+            self.assertEqual(set(occupancy.keys()), set(range(targetSlot - 2, targetSlot + 3)))
+            self.assertEqual(set(occupancy.values()), set([2]))
+
+            # Other callers see the same counts
+            occupancy = collections.Counter(slotOf(due) for due in SyncSlotHistogram.Place(target, timedelta(minutes=3), 2))
+            self.assertEqual(occupancy, collections.Counter([targetSlot - 3, targetSlot + 3]))
+            self._clearSlots(redis)
+
+    def test_spread(self):
+        start = datetime(2015, 6, 1, 12, 0, 0)
+        with patch("tapiriik.sync.schedule.redis", None):
+            with patch("tapiriik.sync.schedule.SYNC_SCHEDULER_TARGET_RATE", None):
+                spread = SyncSlotHistogram.Spread(start, 100)
+                self.assertEqual(len(spread), 100)
+                self.assertEqual(spread, sorted(spread))
+                self.assertTrue(start <= spread[0] and spread[-1] <= start + SyncSlotHistogram.BulkSpread)
+            with patch("tapiriik.sync.schedule.SYNC_SCHEDULER_TARGET_RATE", 10):
+                # As long as the scheduler would take to get through them
+                spread = SyncSlotHistogram.Spread(start, 1000)
+                self.assertTrue(start <= spread[0] and spread[-1] <= start + timedelta(seconds=100))
@@ -19,3 +19,8 @@ def exceptSvc(value):
 @register.filter(name="svc_populate_conns")
 def fullRecords(conns):
     return [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": [x["ID"] for x in conns]}})]
+
+
+@register.filter(name="svc_synchronized_activity_count")
+def synchronizedActivityCount(conn):
+    return db.synchronized_activities.find({"ConnectionID": conn._id}).count() + len(getattr(conn, "SynchronizedActivities", None) or [])
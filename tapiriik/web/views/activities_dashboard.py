@@ -15,21 +15,39 @@ def activities_fetch_json(req):
         return HttpResponse(status=403)
 
     retrieve_fields = [
-        "Activities.Prescence",
-        "Activities.Abscence",
-        "Activities.Type",
-        "Activities.Name",
-        "Activities.StartTime",
-        "Activities.EndTime",
-        "Activities.Private",
-        "Activities.Stationary",
-        "Activities.FailureCounts"
+        "Prescence",
+        "Abscence",
+        "Type",
+        "Name",
+        "StartTime",
+        "EndTime",
+        "Private",
+        "Stationary",
+        "FailureCounts"
     ]
-    activityRecords = db.activity_records.find_one({"UserID": req.user["_id"]}, dict([(x, 1) for x in retrieve_fields]))
-    if not activityRecords:
-        return HttpResponse("[]", content_type="application/json")
+    query = {"UserID": req.user["_id"]}
+    # Optionally, only activities starting within a range of dates (YYYY-MM-DD)
+    startTimeQuery = {}
+    try:
+        if "after" in req.GET:
+            startTimeQuery["$gte"] = datetime.datetime.strptime(req.GET["after"], "%Y-%m-%d")
+        if "before" in req.GET:
+            startTimeQuery["$lt"] = datetime.datetime.strptime(req.GET["before"], "%Y-%m-%d")
+    except ValueError:
+        return HttpResponse(status=400)
+    if startTimeQuery:
+        query["StartTime"] = startTimeQuery
+    # Users who haven't been synced since records moved to one document per activity still have them all in the one document
+    legacyRecords = db.activity_records.find_one({"UserID": req.user["_id"]}, dict([("Activities." + x, 1) for x in retrieve_fields]))
+    if legacyRecords:
+        activityRecords = [x for x in legacyRecords["Activities"] if ("$gte" not in startTimeQuery or x["StartTime"] >= startTimeQuery["$gte"]) and ("$lt" not in startTimeQuery or x["StartTime"] < startTimeQuery["$lt"])]
+        activityRecords.sort(key=lambda x: x["StartTime"], reverse=True)
+    else:
+        fields = dict([(x, 1) for x in retrieve_fields])
+        fields["_id"] = 0
+        activityRecords = db.user_activity_records.find(query, fields).sort("StartTime", -1)
     cleanedRecords = []
-    for activity in activityRecords["Activities"]:
+    for activity in activityRecords:
         # Strip down the record since most of this info isn't displayed
         for presence in activity["Prescence"]:
             del activity["Prescence"][presence]["Exception"]
@@ -3,6 +3,9 @@ from django.http import HttpResponse
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD, SITE_VER
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.schedule import RedisSyncSchedule, SyncSlotHistogram
+from tapiriik.sync.user_logs import UserSyncLogSink
+from pymongo import UpdateOne
 from tapiriik.auth import TOTP, DiagnosticsUser, User
 from bson.objectid import ObjectId
 import hashlib
@@ -77,7 +80,14 @@ def diag_queue_dashboard(req):
         db.users.update({"_id":{"$in":orphanedUserIDs}}, {"$unset": {"SynchronizationWorker": None}}, multi=True)
         delta = True
     if "requeueQueued" in req.POST:
-        db.users.update({"QueuedAt": {"$lt": datetime.utcnow()}, "$or": [{"SynchronizationWorker": {"$exists": False}}, {"SynchronizationWorker": None}]}, {"$set": {"NextSynchronization": datetime.utcnow(), "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True}}, multi=True)
+        requeueQuery = {"QueuedAt": {"$lt": datetime.utcnow()}, "$or": [{"SynchronizationWorker": {"$exists": False}}, {"SynchronizationWorker": None}]}
+        requeueUserIDs = [x["_id"] for x in db.users.find(requeueQuery, {"_id": 1})]
+        # Spread them out, rather than having them all come due at once
+        requeueTimes = SyncSlotHistogram.Spread(datetime.utcnow(), len(requeueUserIDs))
+        if requeueUserIDs:
+            db.users.bulk_write([UpdateOne(dict(requeueQuery, _id=userID), {"$set": {"NextSynchronization": requeueTime, "QueuedGeneration": "manual"}, "$unset": {"QueuedAt": True}}) for userID, requeueTime in zip(requeueUserIDs, requeueTimes)], ordered=False)
+        for userID, requeueTime in zip(requeueUserIDs, requeueTimes):
+            RedisSyncSchedule.Schedule([userID], requeueTime)
 
     if delta:
         return redirect("diagnostics_queue_dashboard")
@@ -179,13 +189,14 @@ def diag_user(req, user):
         except:
             pass
     elif "svc_marksync" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])},
-                              {"$addToSet": {"SynchronizedActivities": req.POST["uid"]}},
-                              multi=False)
+        db.synchronized_activities.update({"ConnectionID": ObjectId(req.POST["id"]), "UID": req.POST["uid"]},
+                                          {"$setOnInsert": {"Timestamp": datetime.utcnow()}},
+                                          upsert=True)
     elif "svc_clearexc" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"ExcludedActivities": 1}})
     elif "svc_clearacts" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        db.synchronized_activities.remove({"ConnectionID": ObjectId(req.POST["id"])})
         Sync.SetNextSyncIsExhaustive(userRec, True)
     elif "svc_toggle_poll_sub" in req.POST:
         from tapiriik.services import Service
@@ -199,17 +210,20 @@ def diag_user(req, user):
         from tapiriik.services import Service
         svcRec = Service.GetServiceRecordByID(req.POST["id"])
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$pull": {"SyncErrors": {"Scope": "activity"}}})
-        act_recs = db.activity_records.find_one({"UserID": ObjectId(user)})
-        for act in act_recs["Activities"]:
-            if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
-                del act["FailureCounts"][svcRec.Service.ID]
-        db.activity_records.save(act_recs)
+        db.user_activity_records.update({"UserID": ObjectId(user), "FailureCounts.%s" % svcRec.Service.ID: {"$exists": True}}, {"$unset": {"FailureCounts.%s" % svcRec.Service.ID: ""}}, multi=True)
+        # Not yet moved over to user_activity_records - the next sync would carry the old counts across otherwise
+        legacy_act_recs = db.activity_records.find_one({"UserID": ObjectId(user)})
+        if legacy_act_recs:
+            for act in legacy_act_recs["Activities"]:
+                if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
+                    del act["FailureCounts"][svcRec.Service.ID]
+            db.activity_records.save(legacy_act_recs)
     else:
         delta = False
 
     if delta:
         return redirect("diagnostics_user", user=user)
-    return render(req, "diag/user.html", {"diag_user": userRec})
+    return render(req, "diag/user.html", {"diag_user": userRec, "sync_logs": UserSyncLogSink.Read(ObjectId(user))})
 
 
 @diag_requireAuth